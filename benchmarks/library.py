@@ -0,0 +1,157 @@
+# -*- encoding: utf-8 -*-
+
+'''library.py: generates synthetic photo libraries for the benchmarks.'''
+
+__author__ = 'drseergio@gmail.com (Sergey Pisarenko)'
+
+import base64
+from datetime import datetime, timedelta
+import os
+import random
+import sys
+import types
+
+# smallest baseline JPEG (1x1, grey), GExiv2 adds the meta-data to it
+_JPEG = base64.b64decode(
+    '/9j/4AAQSkZJRgABAQEASABIAAD/2wBDAP//////////////////////////////////////'
+    '////////////////////////////////////////////////wgALCAABAAEBAREA/8QAFBAB'
+    'AAAAAAAAAAAAAAAAAAAAAP/aAAgBAQABPxA=') + '\xff\xd9'
+_CAMERAS = [
+    ('Canon', 'Canon EOS 5D Mark II'), ('Canon', 'Canon EOS 7D'),
+    ('NIKON CORPORATION', 'NIKON D700'), ('NIKON CORPORATION', 'NIKON D90'),
+    ('FUJIFILM', 'X100'), ('SONY', 'NEX-5N')]
+_LENSES = [
+    ('EF24-70mm f/2.8L USM', '24/1 70/1 28/10 28/10'),
+    ('EF70-200mm f/4L USM', '70/1 200/1 40/10 40/10'),
+    ('EF50mm f/1.4 USM', '50/1 50/1 14/10 14/10'),
+    ('AF-S Nikkor 35mm f/1.8G', '35/1 35/1 18/10 18/10')]
+_FNUMBERS = ['14/10', '18/10', '28/10', '40/10', '56/10', '80/10', '110/10']
+_ISOS = ['100', '200', '400', '800', '1600', '3200', '6400']
+_EXPOSURES = ['1/30', '1/60', '1/125', '1/250', '1/500', '1/1000']
+_SELECT_TAG = 'select'
+
+
+class LibraryGenerator(object):
+  '''Writes a library of photos with random but reproducible meta-data.
+
+  Photos are spread evenly over years starting at start_year and grouped
+  in folders of photos_per_dir per label, like imports from a card. Each
+  photo gets tags_per_photo tags out of a vocabulary of tags, some of them
+  are selects. With mode "stub" every photo is a small text file read by
+  StubMetadata instead of GExiv2, which keeps generating and parsing 1M
+  photos cheap. With mode "jpeg" real JPEG files are written with GExiv2.
+  '''
+  MODES = ('stub', 'jpeg')
+
+  def __init__(self, root, photos, mode='stub', start_year=2003, years=10,
+               tags=200, tags_per_photo=3, labels=100, photos_per_dir=250,
+               seed=0):
+    if mode not in self.MODES:
+      raise ValueError('unknown mode %s' % mode)
+    self.root = root
+    self.photos = photos
+    self.mode = mode
+    self.start = datetime(start_year, 1, 1)
+    self.seconds = int(timedelta(days=365 * years).total_seconds())
+    self.tags = ['tag%04d' % i for i in xrange(tags)]
+    self.tags_per_photo = min(tags_per_photo, tags)
+    self.labels = ['album %04d' % i for i in xrange(labels)]
+    self.photos_per_dir = photos_per_dir
+    self.seed = seed
+
+  def Generate(self):
+    rng = random.Random(self.seed)
+    dates = sorted(self.start + timedelta(seconds=rng.randrange(self.seconds))
+                   for _ in xrange(self.photos))
+    for i, date in enumerate(dates):
+      if i % self.photos_per_dir == 0:
+        label = rng.choice(self.labels)
+        dirname = os.path.join(self.root, date.strftime('%Y'), '%s %s %d' % (
+            date.strftime('%m%d'), label, i / self.photos_per_dir))
+        os.makedirs(dirname)
+      path = os.path.join(dirname, 'IMG_%07d.jpg' % i)
+      tags, values = self._RandomMeta(rng, date, label)
+      if self.mode == 'stub':
+        self._WriteStub(path, tags, values)
+      else:
+        self._WriteJpeg(path, tags, values)
+
+  def _RandomMeta(self, rng, date, label):
+    make, model = rng.choice(_CAMERAS)
+    lens_model, lens_spec = rng.choice(_LENSES)
+    tags = rng.sample(self.tags, self.tags_per_photo)
+    if rng.random() < 0.1:
+      tags.append(_SELECT_TAG)
+    values = {
+        'Exif.Photo.DateTimeOriginal': date.strftime('%Y:%m:%d %H:%M:%S'),
+        'Exif.Photo.FNumber': rng.choice(_FNUMBERS),
+        'Exif.Photo.ISOSpeedRatings': rng.choice(_ISOS),
+        'Exif.Photo.ExposureTime': rng.choice(_EXPOSURES),
+        'Exif.Photo.FocalLength': lens_spec.split(' ')[0],
+        'Exif.Image.Make': make,
+        'Exif.Image.Model': model,
+        'Exif.Photo.LensModel': lens_model,
+        'Exif.Photo.LensSpecification': lens_spec,
+        'Xmp.xmp.Label': label}
+    return tags, values
+
+  def _WriteStub(self, path, tags, values):
+    f = open(path, 'w')
+    for k, v in sorted(values.iteritems()):
+      f.write('%s=%s\n' % (k, v))
+    f.write('Iptc.Application2.Keywords=%s\n' % ','.join(tags))
+    f.close()
+
+  def _WriteJpeg(self, path, tags, values):
+    from gi.repository import GExiv2
+    f = open(path, 'wb')
+    f.write(_JPEG)
+    f.close()
+    meta = GExiv2.Metadata(path)
+    for k, v in values.iteritems():
+      meta.set_tag_string(k, v)
+    meta.set_tag_multiple('Iptc.Application2.Keywords', tags)
+    meta.save_file(path)
+
+
+class StubMetadata(object):
+  '''Reads photos written in "stub" mode, a stand-in for GExiv2.Metadata.'''
+
+  def __init__(self, path):
+    self.values = {}
+    f = open(path)
+    for line in f:
+      k, _sep, v = line.rstrip('\n').partition('=')
+      self.values[k] = v
+    f.close()
+
+  def get(self, k):
+    return self.values.get(k)
+
+  def get_tag_multiple(self, k):
+    return [t for t in self.values.get(k, '').split(',') if t]
+
+  def get_exposure_time(self):
+    return self.values.get('Exif.Photo.ExposureTime')
+
+  def get_focal_length(self):
+    focal_length = self.values.get('Exif.Photo.FocalLength')
+    if not focal_length:
+      return 0.0
+    nom, den = focal_length.split('/')
+    return float(nom) / float(den)
+
+
+def InstallStubGExiv2():
+  '''Makes "from gi.repository import GExiv2" return the stub reader.
+
+  Has to be called before photofs.walker gets imported.
+  '''
+  gexiv2 = types.ModuleType('GExiv2')
+  gexiv2.Metadata = StubMetadata
+  repository = types.ModuleType('gi.repository')
+  repository.GExiv2 = gexiv2
+  gi = types.ModuleType('gi')
+  gi.repository = repository
+  sys.modules['gi'] = gi
+  sys.modules['gi.repository'] = repository
@@ -0,0 +1,192 @@
+# -*- encoding: utf-8 -*-
+
+'''run.py: times indexing, queries and file-system calls of photofs.
+
+Generates a synthetic library, indexes it and calls the PhotoFS methods the
+kernel would call, without mounting anything. Results are written as JSON:
+
+  $ python -m benchmarks.run --photos 100000 --output 100k.json
+'''
+
+__author__ = 'drseergio@gmail.com (Sergey Pisarenko)'
+
+import json
+import logging
+from optparse import OptionParser
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+from benchmarks.library import InstallStubGExiv2, LibraryGenerator
+
+
+class Benchmark(object):
+  def __init__(self, fs, repeat, sample):
+    self.fs = fs
+    self.repeat = repeat
+    self.sample = sample
+    self.results = {}
+
+  def Run(self):
+    fs = self.fs
+    self.Measure('walk.initial', fs.walker.Walk, repeat=1)
+    self.results['walk.initial']['files_per_sec'] = (
+        fs.walker.GetProgress()['rate'])
+    self.Measure('walk.sync', fs.walker._Sync)
+
+    photo_db = fs.views['date'].photo_db
+    years = sorted(photo_db.GetYears())
+    tags = sorted(photo_db.GetTags())[:self.sample]
+    self.Measure('db.GetYears', photo_db.GetYears)
+    self.Measure('db.ListPhotosByYear',
+                 lambda: [photo_db.ListPhotosByYear(y) for y in years],
+                 ops=len(years))
+    self.Measure('db.GetLabels', photo_db.GetLabels)
+    self.Measure('db.GetTags', photo_db.GetTags)
+    self.Measure('db.ListPhotosByTags',
+                 lambda: [photo_db.ListPhotosByTags([t]) for t in tags],
+                 ops=len(tags))
+    self.Measure('db.GetRelatedTags',
+                 lambda: [photo_db.GetRelatedTags([t]) for t in tags],
+                 ops=len(tags))
+    self.Measure('db.GetConfValues',
+                 lambda: photo_db.GetConfValues('make', ['iso'], ['400']))
+    self.Measure('db.ListPhotosByConf',
+                 lambda: photo_db.ListPhotosByConf(['iso', 'f'], ['400', '2.8']))
+
+    dirs = ['/', '/date', '/albums', '/tags', '/camera', '/camera/make']
+    dirs.extend('/date/%s' % y for y in years)
+    dirs.extend('/date/%s/all' % y for y in years)
+    dirs.extend('/tags/%s' % t for t in tags)
+    self.Measure('fs.readdir',
+                 lambda: [list(fs.readdir(d, 0)) for d in dirs], ops=len(dirs))
+
+    files = []
+    for year in years:
+      files.extend('/date/%s/all/%s' % (year, e.name)
+                   for e in fs.readdir('/date/%s/all' % year, 0)
+                   if e.name not in ('.', '..'))
+    files = files[::max(len(files) / self.sample, 1)][:self.sample]
+    self.Measure('fs.getattr',
+                 lambda: [fs.getattr(f) for f in files], ops=len(files))
+    self.Measure('fs.read', lambda: [self._ReadFile(f) for f in files],
+                 ops=len(files))
+    return self.results
+
+  def Measure(self, name, func, repeat=None, ops=1):
+    '''Times func, the first run is reported apart as it fills the caches.'''
+    times = []
+    for _ in xrange(repeat or self.repeat):
+      started = time.time()
+      func()
+      times.append(time.time() - started)
+    first = times[0]
+    times.sort()
+    ops = max(ops, 1)
+    self.results[name] = {
+        'ops': ops,
+        'runs': len(times),
+        'first_ms': first * 1000,
+        'min_ms': times[0] * 1000,
+        'median_ms': times[len(times) / 2] * 1000,
+        'median_per_op_ms': times[len(times) / 2] * 1000 / ops}
+
+  def _ReadFile(self, path):
+    fh = self.fs.open(path, os.O_RDONLY)
+    offset = 0
+    while True:
+      buf = self.fs.read(path, 65536, offset, fh)
+      if not buf:
+        break
+      offset += len(buf)
+    self.fs.release(path, os.O_RDONLY, fh)
+
+
+def main():
+  parser = OptionParser(usage='python -m benchmarks.run [options]')
+  parser.add_option('--photos', type='int', default=10000,
+                    help='Size of the generated library [default: 10000].')
+  parser.add_option('--mode', choices=LibraryGenerator.MODES, default='stub',
+                    help=('"stub" files read by a stand-in for GExiv2 or '
+                          'real "jpeg" files [default: stub].'))
+  parser.add_option('--workdir', metavar='PATH',
+                    help=('Keep the library and the index here, an existing '
+                          'library is reused [default: a temporary folder].'))
+  parser.add_option('--index_workers', type='int', default=1,
+                    help='Processes reading meta-data [default: 1].')
+  parser.add_option('--memory_index', action='store_true',
+                    help='Benchmark with the in-memory views.')
+  parser.add_option('--naming', choices=['index', 'date'], default='index',
+                    help='How photos are named [default: index].')
+  parser.add_option('--repeat', type='int', default=5,
+                    help='Runs of every measurement [default: 5].')
+  parser.add_option('--sample', type='int', default=1000,
+                    help='Most photos and tags a measurement uses '
+                         '[default: 1000].')
+  parser.add_option('--output', metavar='FILE',
+                    help='Write the results here [default: stdout].')
+  options, _args = parser.parse_args()
+
+  if options.mode == 'stub':
+    InstallStubGExiv2()
+  # imported after the stub, photofs.walker imports GExiv2 right away
+  from photofs_main import PhotoFS
+
+  workdir = options.workdir or tempfile.mkdtemp(prefix='photofs-benchmark')
+  try:
+    root = os.path.join(workdir, 'library')
+    generate_sec = None
+    if not os.path.isdir(root):
+      started = time.time()
+      LibraryGenerator(root, options.photos, options.mode).Generate()
+      generate_sec = time.time() - started
+    index_dir = os.path.join(workdir, 'index')
+    shutil.rmtree(index_dir, True)  # always index from scratch
+
+    fs = PhotoFS()
+    fs.root = root
+    fs.index_dir = index_dir
+    fs.read_only = False
+    fs.index_workers = options.index_workers
+    fs.memory_index = options.memory_index
+    fs.naming = options.naming
+    fs.file_cache_mb = PhotoFS._FILE_CACHE_MB
+    fs.max_open_files = PhotoFS._MAX_OPEN_FILES
+    fs.max_watches = 0
+    fs.thumb_cache_mb = PhotoFS._THUMB_CACHE_MB
+    fs.profile_dir = os.environ.get(PhotoFS._PROFILE_DIR_ENV)
+    fs.Setup()
+    if fs.profiler:
+      fs.profiler.Start()
+    results = Benchmark(fs, options.repeat, options.sample).Run()
+    if fs.profiler:
+      fs.profiler.Dump()
+  finally:
+    if not options.workdir:
+      shutil.rmtree(workdir, True)
+
+  report = {
+      'timestamp': int(time.time()),
+      'python': platform.python_version(),
+      'platform': platform.platform(),
+      'config': {
+          'photos': options.photos,
+          'mode': options.mode,
+          'index_workers': options.index_workers,
+          'memory_index': bool(options.memory_index),
+          'naming': options.naming,
+          'repeat': options.repeat,
+          'sample': options.sample},
+      'generate_sec': generate_sec,
+      'results': results}
+  output = open(options.output, 'w') if options.output else sys.stdout
+  json.dump(report, output, indent=2, sort_keys=True)
+  output.write('\n')
+
+
+if __name__ == '__main__':
+  logging.basicConfig(level=logging.WARNING)
+  main()
@@ -0,0 +1,161 @@
+# -*- encoding: utf-8 -*-
+
+'''buffers.py: holds the temp files exiv2 writes before replacing a photo.'''
+
+__author__ = 'drseergio@gmail.com (Sergey Pisarenko)'
+
+import errno
+import logging
+import os
+import shutil
+import StringIO
+import tempfile
+from threading import Lock, Timer
+from time import time
+
+TMP_PREFIX = '.photofs-tmp-'  # of temp files next to photos, never indexed
+
+
+class TmpBufferTable(object):
+  '''Keeps the buffers of exiv2 temp files until they are renamed.
+
+  Once started, buffers not touched for _TIMEOUT_SEC are dropped, exiv2 may
+  have given up on them or the process writing died.
+  '''
+  _MAX_MEMORY = 1 << 20  # larger buffers go to disk
+  _TIMEOUT_SEC = 60 * 10
+  _SWEEP_INTERVAL_SEC = 60
+
+  def __init__(self):
+    self.lock = Lock()
+    self.buffers = {}
+
+  def Start(self):
+    self._ScheduleSweep()
+
+  def Get(self, key, real_path=None):
+    '''Returns the buffer of key, a new one next to real_path if given.'''
+    self.lock.acquire()
+    tmp_buffer = self.buffers.get(key)
+    if tmp_buffer is None and real_path:
+      tmp_buffer = TmpBuffer(os.path.dirname(real_path), self._MAX_MEMORY)
+      self.buffers[key] = tmp_buffer
+    self.lock.release()
+    return tmp_buffer
+
+  def Pop(self, key):
+    self.lock.acquire()
+    tmp_buffer = self.buffers.pop(key, None)
+    self.lock.release()
+    return tmp_buffer
+
+  def _Sweep(self):
+    self.lock.acquire()
+    expired = [k for k, b in self.buffers.iteritems()
+               if time() - b.used > self._TIMEOUT_SEC]
+    tmp_buffers = [self.buffers.pop(k) for k in expired]
+    self.lock.release()
+    for key, tmp_buffer in zip(expired, tmp_buffers):
+      logging.warning('Dropping abandoned temp file %s', key)
+      tmp_buffer.Discard()
+    self._ScheduleSweep()
+
+  def _ScheduleSweep(self):
+    t = Timer(self._SWEEP_INTERVAL_SEC, self._Sweep)
+    t.daemon = True
+    t.start()
+
+
+class TmpBuffer(object):
+  '''A temp file kept in memory until it grows over max_memory.
+
+  On disk it lives in dirname, next to the photo it will replace, so the
+  replacement is a single rename. If dirname isn't writable the system temp
+  folder is used and the photo is overwritten with a copy instead.
+  '''
+  def __init__(self, dirname, max_memory):
+    self.dirname = dirname
+    self.max_memory = max_memory
+    self.lock = Lock()
+    self.file = StringIO.StringIO()
+    self.path = None  # set once the buffer is on disk
+    self.size = 0
+    self.used = time()
+
+  def Read(self, length, offset):
+    self.lock.acquire()
+    try:
+      self.used = time()
+      self.file.seek(offset)
+      return self.file.read(length)
+    finally:
+      self.lock.release()
+
+  def Write(self, buf, offset):
+    self.lock.acquire()
+    try:
+      self.used = time()
+      self.file.seek(offset)
+      self.file.write(buf)
+      self.size = max(self.size, offset + len(buf))
+      if self.path is None and self.size > self.max_memory:
+        self._Spill()
+      return len(buf)
+    finally:
+      self.lock.release()
+
+  def Truncate(self, length):
+    self.lock.acquire()
+    try:
+      self.used = time()
+      self.file.truncate(length)
+      self.size = length
+    finally:
+      self.lock.release()
+
+  def Commit(self, real_path):
+    '''Replaces real_path with the buffer, the buffer can't be used after.'''
+    self.lock.acquire()
+    try:
+      if self.path is None:
+        self._Spill()
+      self.file.flush()
+      os.fsync(self.file.fileno())
+      try:
+        os.chmod(self.path, os.stat(real_path).st_mode & 07777)
+      except OSError:
+        pass
+      if os.path.dirname(self.path) == self.dirname:
+        self.file.close()
+        os.rename(self.path, real_path)
+      else:
+        self.file.seek(0)
+        real_fh = open(real_path, 'wb')
+        shutil.copyfileobj(self.file, real_fh)
+        real_fh.close()
+        self.file.close()
+        os.remove(self.path)
+    finally:
+      self.lock.release()
+
+  def Discard(self):
+    self.lock.acquire()
+    self.file.close()
+    if self.path:
+      try:
+        os.remove(self.path)
+      except OSError, e:
+        if e.errno != errno.ENOENT:
+          logging.error('Failed removing %s', self.path)
+    self.lock.release()
+
+  def _Spill(self):
+    try:
+      fd, path = tempfile.mkstemp(prefix=TMP_PREFIX, dir=self.dirname)
+    except OSError:
+      fd, path = tempfile.mkstemp(prefix=TMP_PREFIX)
+    disk_file = os.fdopen(fd, 'w+b')
+    disk_file.write(self.file.getvalue())
+    self.file.close()
+    self.file = disk_file
+    self.path = path
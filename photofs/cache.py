@@ -0,0 +1,118 @@
+# -*- encoding: utf-8 -*-
+
+'''cache.py: remembers where photos live and their file attributes.'''
+
+__author__ = 'drseergio@gmail.com (Sergey Pisarenko)'
+
+from collections import OrderedDict
+import os
+from threading import Lock
+
+
+class PhotoFileCache(object):
+  '''Bounded LRU mapping photo ids to real paths and os.stat results.
+
+  Every getattr, open and read of a photo needs its real path and most need
+  its stat, the cache saves a query and a stat call for each of them. The
+  memory budget is enforced using an estimate of the size of each entry.
+  Entries are dropped when PhotoDb reports a photo changed or deleted and
+  when the watcher sees the underlying file being written or removed.
+  '''
+  _ENTRY_OVERHEAD = 512  # rough bytes taken by an entry besides its path
+
+  def __init__(self, db, max_bytes):
+    self.db = db
+    self.max_bytes = max_bytes
+    self.used_bytes = 0
+    self.lock = Lock()
+    self.entries = OrderedDict()  # id -> [path, stat or None, size]
+    self.path_ids = {}
+    self.stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+    self.generation = 0  # bumped by every invalidation
+    db.AddListener(self)
+
+  def GetRealPath(self, photo_id):
+    entry = self._GetEntry(photo_id)
+    if entry:
+      return entry[0]
+    return None
+
+  def GetStat(self, photo_id):
+    '''Returns (real path, stat) of a photo or None if there's no such photo.'''
+    entry = self._GetEntry(photo_id)
+    if not entry:
+      return None
+    if entry[1] is None:
+      try:
+        entry[1] = os.stat(entry[0])
+      except OSError:
+        self.Invalidate(entry[0])
+        return None
+    return entry[0], entry[1]
+
+  def Invalidate(self, path):
+    self.lock.acquire()
+    self.generation += 1
+    photo_id = self.path_ids.get(path)
+    if photo_id is not None:
+      self._Delete(photo_id)
+    self.lock.release()
+
+  def OnPhotosChanged(self, photos, removed):
+    for photo in photos + removed:
+      self.Invalidate(photo['path'])
+
+  def OnIndexChanged(self):
+    self.lock.acquire()
+    self.generation += 1
+    self.stats['evictions'] += len(self.entries)
+    self.entries = OrderedDict()
+    self.path_ids = {}
+    self.used_bytes = 0
+    self.lock.release()
+
+  def GetStats(self):
+    self.lock.acquire()
+    stats = dict(self.stats)
+    stats['entries'] = len(self.entries)
+    stats['bytes'] = self.used_bytes
+    self.lock.release()
+    return stats
+
+  def _GetEntry(self, photo_id):
+    self.lock.acquire()
+    entry = self.entries.pop(photo_id, None)
+    if entry:
+      self.entries[photo_id] = entry  # most recently used goes last
+      self.stats['hits'] += 1
+    else:
+      self.stats['misses'] += 1
+    generation = self.generation
+    self.lock.release()
+    if entry:
+      return entry
+
+    real_path = self.db.GetRealPhotoPath(photo_id)
+    if not real_path:
+      return None
+    entry = [real_path, None, self._ENTRY_OVERHEAD + len(real_path)]
+    self.lock.acquire()
+    if generation != self.generation:  # the path may be stale already
+      self.lock.release()
+      return entry
+    if photo_id in self.entries:
+      self._Delete(photo_id)
+    self.entries[photo_id] = entry
+    self.path_ids[real_path] = photo_id
+    self.used_bytes += entry[2]
+    while self.used_bytes > self.max_bytes and self.entries:
+      self._Delete(next(iter(self.entries)))
+      self.stats['evictions'] += 1
+    self.lock.release()
+    return entry
+
+  def _Delete(self, photo_id):
+    path, _stat, size = self.entries.pop(photo_id)
+    if self.path_ids.get(path) == photo_id:
+      del self.path_ids[path]
+    self.used_bytes -= size
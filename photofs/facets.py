@@ -0,0 +1,105 @@
+# -*- encoding: utf-8 -*-
+
+'''facets.py: indexes camera settings of photos in memory.'''
+
+__author__ = 'drseergio@gmail.com (Sergey Pisarenko)'
+
+from threading import Lock
+
+
+class FacetIndex(object):
+  '''Answers the camera queries of PhotoDb from in-memory facets.
+
+  For every camera parameter the index maps each distinct value to the ids
+  of the photos having it, so browsing gear combinations intersects sets
+  instead of scanning the files table. The facets follow every write made
+  through PhotoDb. Everything else is passed through to PhotoDb.
+  '''
+  PARAMS = (
+      'f', 'iso', 'make', 'camera', 'focal_length', 'lens_model', 'lens_spec')
+
+  def __init__(self, db):
+    self.db = db
+    self.lock = Lock()
+    self.photos = {}  # id -> (datetime, values of PARAMS)
+    self.facets = dict((p, {}) for p in self.PARAMS)  # param -> value -> ids
+    self._Build()
+    db.AddListener(self)
+
+  def __getattr__(self, name):
+    return getattr(self.db, name)
+
+  def GetConfValues(self, conf, confs=(), values=()):
+    return set(self.GetConfValueCounts(conf, confs, values))
+
+  def GetConfValueCounts(self, conf, confs=(), values=()):
+    '''Returns {value: number of photos} of conf among matching photos.'''
+    self.lock.acquire()
+    if not confs:
+      counts = dict((v, len(ids)) for v, ids in self.facets[conf].iteritems())
+    else:
+      counts = {}
+      position = self.PARAMS.index(conf)
+      for photo_id in self._Filter(confs, values):
+        value = self.photos[photo_id][1][position]
+        if value:
+          counts[value] = counts.get(value, 0) + 1
+    self.lock.release()
+    return counts
+
+  def IsConfValueValid(self, conf, value):
+    return value in self.facets[conf]
+
+  def ListPhotosByConf(self, confs, values):
+    self.lock.acquire()
+    photos = sorted(self._Filter(confs, values),
+                    key=lambda i: (self.photos[i][0], i))
+    self.lock.release()
+    return photos
+
+  def OnIndexChanged(self):
+    self._Build()
+
+  def OnPhotosChanged(self, photos, removed):
+    self.lock.acquire()
+    for photo in photos + removed:
+      self._Remove(photo['id'])
+    for photo in photos:
+      self._Add(photo['id'], photo['datetime'],
+                [photo[p] for p in self.PARAMS])
+    self.lock.release()
+
+  def _Build(self):
+    rows = self.db.GetAllPhotoConfs(self.PARAMS)
+    self.lock.acquire()
+    self.photos = {}
+    self.facets = dict((p, {}) for p in self.PARAMS)
+    for row in rows:
+      self._Add(row[0], row[1], row[2:])
+    self.lock.release()
+
+  def _Filter(self, confs, values):
+    postings = [self.facets[c].get(v, set()) for c, v in zip(confs, values)]
+    if not postings:
+      return set(self.photos)
+    postings.sort(key=len)  # start from the most selective value
+    return postings[0].intersection(*postings[1:])
+
+  def _Add(self, photo_id, datetime, values):
+    # the views compare values with folder names, which are strings
+    values = tuple(str(v) if v else None for v in values)
+    self.photos[photo_id] = (datetime, values)
+    for param, value in zip(self.PARAMS, values):
+      if value:
+        self.facets[param].setdefault(value, set()).add(photo_id)
+
+  def _Remove(self, photo_id):
+    photo = self.photos.pop(photo_id, None)
+    if photo is None:
+      return
+    for param, value in zip(self.PARAMS, photo[1]):
+      if value:
+        ids = self.facets[param][value]
+        ids.discard(photo_id)
+        if not ids:
+          del self.facets[param][value]
@@ -0,0 +1,102 @@
+# -*- encoding: utf-8 -*-
+
+'''handles.py: keeps real files open between FUSE open and release.'''
+
+__author__ = 'drseergio@gmail.com (Sergey Pisarenko)'
+
+from collections import OrderedDict
+import os
+from threading import Lock
+
+
+class FileHandleTable(object):
+  '''Tracks the handles returned by open and caps the open descriptors.
+
+  A handle keeps the descriptor of its real file until it's released. Once
+  more than max_fds descriptors are open the least recently used idle one
+  is closed, its handle opens the file again on the next read or write.
+  '''
+
+  def __init__(self, max_fds):
+    self.max_fds = max_fds
+    self.lock = Lock()
+    self.active = OrderedDict()  # handles with an open descriptor
+
+  def Open(self, path, flags):
+    access = flags & (os.O_RDONLY | os.O_WRONLY | os.O_RDWR)
+    handle = FileHandle(self, path, access)
+    handle.lock.acquire()
+    try:
+      self._Activate(handle)
+    finally:
+      handle.lock.release()
+    return handle
+
+  def Release(self, handle):
+    handle.lock.acquire()
+    self.lock.acquire()
+    self.active.pop(handle, None)
+    self.lock.release()
+    if handle.fd is not None:
+      os.close(handle.fd)
+      handle.fd = None
+    handle.lock.release()
+
+  def GetStats(self):
+    self.lock.acquire()
+    stats = {'open_fds': len(self.active)}
+    self.lock.release()
+    return stats
+
+  def _Activate(self, handle):
+    '''Returns the descriptor of handle, the caller holds handle.lock.'''
+    self.lock.acquire()
+    try:
+      if handle.fd is not None:
+        del self.active[handle]
+        self.active[handle] = True  # most recently used goes last
+        return handle.fd
+
+      handle.fd = os.open(handle.path, handle.flags)
+      self.active[handle] = True
+      for other in self.active.keys():
+        if len(self.active) <= self.max_fds:
+          break
+        # never close a descriptor another thread is reading from
+        if other is handle or not other.lock.acquire(False):
+          continue
+        del self.active[other]
+        os.close(other.fd)
+        other.fd = None
+        other.lock.release()
+      return handle.fd
+    finally:
+      self.lock.release()
+
+
+class FileHandle(object):
+  def __init__(self, table, path, flags):
+    self.table = table
+    self.path = path
+    self.flags = flags
+    self.fd = None
+    self.lock = Lock()
+
+  def Read(self, length, offset):
+    # Python 2 has no os.pread, the lock keeps seek and read together
+    self.lock.acquire()
+    try:
+      fd = self.table._Activate(self)
+      os.lseek(fd, offset, os.SEEK_SET)
+      return os.read(fd, length)
+    finally:
+      self.lock.release()
+
+  def Write(self, buf, offset):
+    self.lock.acquire()
+    try:
+      fd = self.table._Activate(self)
+      os.lseek(fd, offset, os.SEEK_SET)
+      return os.write(fd, buf)
+    finally:
+      self.lock.release()
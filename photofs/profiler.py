@@ -0,0 +1,113 @@
+# -*- encoding: utf-8 -*-
+
+'''profiler.py: samples where photofs threads spend their time.'''
+
+__author__ = 'drseergio@gmail.com (Sergey Pisarenko)'
+
+import logging
+import os
+import sys
+import thread
+import threading
+import time
+
+
+class SamplingProfiler(object):
+  '''Periodically records the stacks of all threads and writes them out.
+
+  A thread busy with a FUSE operation is accounted as "fuse-<operation>",
+  threads photofs named by their name, e.g. "photofs-indexer", and all
+  others, timers and idle FUSE threads among them, as "other". Every
+  _DUMP_INTERVAL_SEC the stacks sampled so far are written to directory,
+  one file per thread or operation, in the folded format read by
+  flamegraph.pl and speedscope. Nothing is sampled unless it's started.
+  '''
+  _SAMPLE_INTERVAL_SEC = 0.01
+  _THREAD_PREFIX = 'photofs-'
+  _OTHER = 'other'
+  _DUMP_INTERVAL_SEC = 60
+
+  def __init__(self, directory):
+    self.directory = directory
+    self.ops = {}  # thread id -> FUSE operation it's running
+    self.samples = {}  # thread or operation -> {stack: count}
+    self.lock = threading.Lock()
+
+  def Start(self):
+    if not os.path.isdir(self.directory):
+      os.makedirs(self.directory)
+    sampler = threading.Thread(target=self._Run, name='photofs-profiler')
+    sampler.daemon = True
+    sampler.start()
+    logging.info('Writing profiles to %s', self.directory)
+
+  def EnterOp(self, op):
+    self.ops[thread.get_ident()] = op
+
+  def LeaveOp(self):
+    self.ops.pop(thread.get_ident(), None)
+
+  def ProfileIterator(self, iterator, op):
+    '''Accounts the work of a generator, like readdir, to op.'''
+    while True:
+      self.EnterOp(op)
+      try:
+        item = next(iterator)
+      except StopIteration:
+        return
+      finally:
+        self.LeaveOp()
+      yield item
+
+  def _Run(self):
+    own_id = thread.get_ident()
+    dumped = time.time()
+    while True:
+      time.sleep(self._SAMPLE_INTERVAL_SEC)
+      self._Sample(own_id)
+      if time.time() - dumped >= self._DUMP_INTERVAL_SEC:
+        dumped = time.time()
+        self.Dump()
+
+  def Dump(self):
+    self.lock.acquire()
+    try:
+      for name, counts in self.samples.iteritems():
+        path = os.path.join(self.directory, '%s.folded' % name)
+        tmp_path = '%s.tmp' % path
+        f = open(tmp_path, 'w')
+        for stack, count in sorted(counts.iteritems()):
+          f.write('%s %d\n' % (stack, count))
+        f.close()
+        os.rename(tmp_path, path)  # readers never see half a profile
+    except (IOError, OSError), e:
+      logging.error('Failed writing profiles')
+      logging.exception(e)
+    finally:
+      self.lock.release()
+
+  def _Sample(self, own_id):
+    names = dict((t.ident, t.name) for t in threading.enumerate())
+    self.lock.acquire()
+    for thread_id, frame in sys._current_frames().iteritems():
+      if thread_id == own_id:
+        continue
+      op = self.ops.get(thread_id)
+      if op:
+        name = 'fuse-%s' % op
+      else:
+        # a file per unnamed thread would pile up as their ids keep changing
+        name = names.get(thread_id, '')
+        if not name.startswith(self._THREAD_PREFIX):
+          name = self._OTHER
+      stack = []
+      while frame:
+        code = frame.f_code
+        stack.append('%s (%s:%d)' % (
+            code.co_name, os.path.basename(code.co_filename),
+            code.co_firstlineno))
+        frame = frame.f_back
+      stack = ';'.join(reversed(stack))
+      counts = self.samples.setdefault(name, {})
+      counts[stack] = counts.get(stack, 0) + 1
+    self.lock.release()
@@ -0,0 +1,62 @@
+# -*- encoding: utf-8 -*-
+
+'''stats.py: counts FUSE operations and how long they take.'''
+
+__author__ = 'drseergio@gmail.com (Sergey Pisarenko)'
+
+from bisect import bisect_left
+from threading import Lock
+import time
+
+
+class OpStats(object):
+  '''Call and error counts and latency histograms per operation and view.
+
+  Histograms are lists of counts, the n-th counts the calls that took up to
+  BUCKETS_MS[n] milliseconds and the last one those that took longer.
+  '''
+  BUCKETS_MS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000)
+
+  def __init__(self):
+    self.lock = Lock()
+    self.ops = {}  # (op, view) -> [calls, errors, total ms, bucket counts]
+
+  def Record(self, op, view, seconds, error=False):
+    ms = seconds * 1000
+    bucket = bisect_left(self.BUCKETS_MS, ms)
+    self.lock.acquire()
+    entry = self.ops.get((op, view))
+    if entry is None:
+      entry = [0, 0, 0.0, [0] * (len(self.BUCKETS_MS) + 1)]
+      self.ops[(op, view)] = entry
+    entry[0] += 1
+    if error:
+      entry[1] += 1
+    entry[2] += ms
+    entry[3][bucket] += 1
+    self.lock.release()
+
+  def TimeIterator(self, iterator, op, view, started):
+    '''Records op once iterator is exhausted, for generators like readdir.'''
+    error = False
+    try:
+      for item in iterator:
+        yield item
+    except Exception:
+      error = True
+      raise
+    finally:
+      self.Record(op, view, time.time() - started, error)
+
+  def GetStats(self):
+    '''Returns {op: {view: {calls, errors, total_ms, histogram}}}.'''
+    self.lock.acquire()
+    stats = {}
+    for (op, view), (calls, errors, total_ms, buckets) in self.ops.iteritems():
+      stats.setdefault(op, {})[view] = {
+          'calls': calls,
+          'errors': errors,
+          'total_ms': total_ms,
+          'histogram': list(buckets)}
+    self.lock.release()
+    return stats
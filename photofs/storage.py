@@ -4,27 +4,61 @@
 
 __author__ = 'drseergio@gmail.com (Sergey Pisarenko)'
 
+from collections import OrderedDict
+from contextlib import contextmanager
 import fcntl
 import hashlib
+import logging
 import os
+import Queue
 import sqlite3
+from array import array
 from threading import Lock, Timer
+from time import time
 
 
 class PhotoDb(object):
   _CONF_DIR = os.path.join(os.path.expanduser('~'), '.photofs')
   _COLUMNS = [
       'path', 'datetime', 'last_modified', 'year', 'month', 'day', 'f','iso',
-      'make', 'camera', 'focal_length', 'lens_model', 'lens_spec', 'label']
+      'make', 'camera', 'focal_length', 'lens_model', 'lens_spec', 'label',
+      'size']
   _CACHE_REFRESH_MIN = 3  # check if cache is valid and build if needed
+  _CACHED_STATEMENTS = 256  # prepared statements kept per connection
+  _MAX_CONNECTIONS = 8  # callers wait for a free one beyond that
+  _BUSY_TIMEOUT_SEC = 30  # wait for the writer instead of failing
+  _MAX_QUERY_PARAMS = 500  # stay below SQLITE_MAX_VARIABLE_NUMBER
+  _CACHED_SETS = {'year': 'years', 'label': 'labels', 'tag': 'tags'}
+  _TAG_INDEX_TYPECODE = 'I'  # photo ids are stored as unsigned ints
+  _SCHEMA_VERSION = 3  # PRAGMA user_version of an up to date index
+  _CHANGES_POLL_SEC = 2  # how often read-only instances look for writes
+  _CHANGES_LOG_SIZE = 100  # writes kept in the log for read-only instances
+  _CONF_COLUMNS = [
+      'f', 'iso', 'make', 'camera', 'focal_length', 'lens_model', 'lens_spec']
 
-  def __init__(self, path):
-    self._CreateConfFolder()
-    self.db_path = os.path.join(self._CONF_DIR, self._GenerateDbId(path))
+  def __init__(self, path, index_dir=None):
+    self.index_dir = index_dir or self._CONF_DIR
+    self.db_path = os.path.join(self.index_dir, self._GenerateDbId(path))
     self.db_existed = os.path.isfile(self.db_path)
+    if self.db_existed:
+      self.last_change = int(os.path.getmtime(self.db_path))
+    else:
+      self.last_change = int(time())
+    # folders nothing was written to since are as old as the loaded index
+    self.loaded = self.last_change
+    self.folder_changes = {}  # (kind, values..) -> time of the last write
     self.unique_tags = set()
-    self.cache = {}
+    self.cache = {}  # key -> (value, dependencies)
+    self.cache_stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+    self.cache_generation = 0  # bumped by every invalidation
     self.cache_lock = Lock()
+    self.pool = Queue.Queue()  # idle connections
+    self.pool_size = 0  # connections opened, idle or in use
+    self.pool_lock = Lock()
+    self.listeners = []
+    self.write_lock = Lock()  # keeps listeners seeing writes in order
+    self.read_only = False
+    self.changes = None  # value of the 'changes' counter last seen
 
     t = Timer(self._CACHE_REFRESH_MIN * 60, self._PeriodicBuildCache)
     t.daemon = True
@@ -37,10 +71,22 @@ class PhotoDb(object):
     for year in years:
       self.ListPhotosByYear(year)
 
+  def GetLastChange(self, *key):
+    '''Returns when photos were last written, used as mtime of folders.
+
+    With a key such as ('month', '2009', '05') only writes of photos that are
+    or were listed in that folder count, ('year', year), ('day', year, month,
+    day), ('label', label) and ('tag', tag) are known as well.
+    '''
+    if key:
+      return self.folder_changes.get(key, self.loaded)
+    return self.last_change
+
   def IsEmptyDb(self):
     return not self.db_existed
 
   def TryLock(self):
+    self._CreateConfFolder()
     lock_path = '%s%s' % (self.db_path, '.lock')
     try:
       self.lock_fd = open(lock_path, 'w')
@@ -51,302 +97,1047 @@ class PhotoDb(object):
     self._CreateTables()
     return True
 
+  def OpenReadOnly(self):
+    '''Opens the index without the lock, it's written by another instance.
+
+    Returns False if there's no index yet or it needs migrating, only the
+    instance holding the lock can do that. WAL lets this instance read while
+    the other one writes, FollowChanges picks up what it wrote.
+    '''
+    if not self.db_existed:
+      return False
+    self.read_only = True
+    with self._Connection() as conn:
+      version = conn.execute('PRAGMA user_version').fetchone()[0]
+    if version != self._SCHEMA_VERSION:
+      return False
+    self.changes = self._GetChanges()
+    return True
+
+  def FollowChanges(self):
+    '''Checks for writes of the locking instance every _CHANGES_POLL_SEC.
+
+    The writes are read from the log and passed to OnPhotosChanged of the
+    listeners. An instance that fell behind the log calls OnIndexChanged.
+    '''
+    t = Timer(self._CHANGES_POLL_SEC, self._PollChanges)
+    t.daemon = True
+    t.start()
+
+  def AddListener(self, listener):
+    '''Calls listener.OnPhotosChanged(photos, removed) after every write.
+
+    photos are the meta-data dicts of new and changed photos with their 'id'
+    added, removed are {'id': .., 'path': ..} dicts of deleted photos.
+    Read-only instances call it for the writes of the locking instance, or
+    listener.OnIndexChanged() if they can't tell what was written.
+    '''
+    self.listeners.append(listener)
+
   def StorePhoto(self, path, meta):
-    conn = sqlite3.connect(self.db_path)
-    cursor = conn.cursor()
-    values = [meta[c] for c in self._COLUMNS]
-    cursor.execute('''INSERT INTO `files` (%s)
-        VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ''' % ','.join(self._COLUMNS),
-        values)
-    if meta['tags']:
-      self._HandleTags(cursor, meta['tags'], path, meta['datetime'])
-    conn.commit()
-    conn.close()
-    self._EmptyCache()
+    self.WriteBatch([meta], [], [])
 
   def UpdatePhoto(self, path, meta):
-    conn = sqlite3.connect(self.db_path)
-    cursor = conn.cursor()
-    values = [meta[c] for c in self._COLUMNS]
-    values.append(path)
-    cursor.execute('''UPDATE `files` SET %s
-        WHERE path = ?''' % ', '.join(['%s = ?' % c for c in self._COLUMNS]),
-        values)
-    cursor.execute('DELETE FROM files_tags WHERE path = ?', (path,))
-    if meta['tags']:
-      self._HandleTags(cursor, meta['tags'], path, meta['datetime'])
-    conn.commit()
-    conn.close()
-    self._EmptyCache()
+    self.WriteBatch([], [meta], [])
+
+  def WriteBatch(self, stored, updated, deleted):
+    '''Applies new, changed and deleted photos in a single transaction.
+
+    stored and updated are lists of meta-data dicts as returned by
+    PhotoWalker.ReadMetadata, deleted is a list of real paths.
+    '''
+    if not stored and not updated and not deleted:
+      return
+    self.write_lock.acquire()
+    try:
+      self._WriteBatch(stored, updated, deleted)
+    finally:
+      self.write_lock.release()
+
+  def _WriteBatch(self, stored, updated, deleted):
+    with self._Connection() as conn:
+      with conn:  # commits, or rolls back so the connection stays usable
+        cursor = conn.cursor()
+        # the walker and the watcher may both store a photo, whoever comes
+        # second updates it, and a photo updated while it was deleted is
+        # stored again; the last meta-data given for a path wins
+        deleted_paths = set(deleted)
+        metas = updated + stored
+        existing = self._GetPhotoIds(cursor, [
+            m['path'] for m in metas if m['path'] not in deleted_paths])
+        updated = OrderedDict((m['path'], m) for m in metas
+                              if m['path'] in existing).values()
+        stored = OrderedDict((m['path'], m) for m in metas
+                             if m['path'] not in existing).values()
+        old_values = self._GetCachedValues(
+            cursor, deleted + [m['path'] for m in updated])
+        removed = [{'id': photo_id, 'path': path} for path, photo_id
+                   in self._GetPhotoIds(cursor, deleted).iteritems()]
+        if deleted:
+          cursor.executemany(
+              '''DELETE FROM files_tags WHERE files_rowid IN (
+              SELECT id FROM files WHERE path = ?)''', [(p,) for p in deleted])
+          cursor.executemany(
+              'DELETE FROM files WHERE path = ?', [(p,) for p in deleted])
+        if updated:
+          cursor.executemany(
+              'UPDATE `files` SET %s WHERE path = ?' % ', '.join(
+                  ['%s = ?' % c for c in self._COLUMNS]),
+              [[m[c] for c in self._COLUMNS] + [m['path']] for m in updated])
+          cursor.executemany(
+              '''DELETE FROM files_tags WHERE files_rowid IN (
+              SELECT id FROM files WHERE path = ?)''',
+              [(m['path'],) for m in updated])
+        if stored:
+          cursor.executemany(
+              'INSERT INTO `files` (%s) VALUES(%s)' % (
+                  ','.join(self._COLUMNS), ','.join('?' * len(self._COLUMNS))),
+              [[m[c] for c in self._COLUMNS] for m in stored])
+        self._HandleTags(cursor, updated + stored)
+        cursor.execute(
+            'UPDATE `counters` SET `value` = `value` + 1 WHERE name = ?',
+            ('changes',))
+        ids = self._GetPhotoIds(cursor, [m['path'] for m in updated + stored])
+        photos = [dict(m, id=ids[m['path']]) for m in updated + stored]
+        new_values = {
+            'year': set(), 'date': set(), 'label': set(), 'tag': set()}
+        for meta in photos:
+          new_values['year'].add(str(meta['year']))
+          new_values['date'].add(
+              (str(meta['year']), str(meta['month']), str(meta['day'])))
+          if meta['label']:  # photos without one aren't in any album
+            new_values['label'].add(str(meta['label']))
+          new_values['tag'].update(t.lower() for t in meta['tags'] or [])
+        folders = self._GetFolders(old_values) | self._GetFolders(new_values)
+        self._LogChange(cursor, photos, removed, folders)
+      cursor.close()
+    self.last_change = int(time())
+    for listener in self.listeners:
+      listener.OnPhotosChanged(photos, removed)
+    self._TouchFolders(folders)
+    self._InvalidateCache(old_values, new_values)
 
   def GetYears(self):
-    cached = self._GetCache('years')
+    cached, generation = self._GetCache('years')
     if cached:
       return cached
-    conn = sqlite3.connect(self.db_path)
-    cursor = conn.cursor()
-    years = set([])
-    for row in cursor.execute('SELECT year FROM files'):
-      years.add(str(row[0]))
-    conn.close()
-    self._SetCache('years', years)
+    with self._Connection() as conn:
+      cursor = conn.cursor()
+      years = set([])
+      for row in cursor.execute('SELECT DISTINCT year FROM date_counts'):
+        years.add(str(row[0]))
+      cursor.close()
+    self._SetCache('years', years, generation)
     return years
 
   def GetMonths(self, year):
-    conn = sqlite3.connect(self.db_path)
-    cursor = conn.cursor()
-    months = set([])
-    for row in cursor.execute(
-        'SELECT month FROM files WHERE year = ?', (year,)):
-      months.add(str(row[0]))
-    conn.close()
+    with self._Connection() as conn:
+      cursor = conn.cursor()
+      months = set([])
+      for row in cursor.execute(
+          'SELECT DISTINCT month FROM date_counts WHERE year = ?', (year,)):
+        months.add(str(row[0]))
+      cursor.close()
     return months
 
   def GetDays(self, year, month):
-    conn = sqlite3.connect(self.db_path)
-    cursor = conn.cursor()
-    days = set([])
-    for row in cursor.execute(
-        'SELECT day FROM files WHERE year = ? AND month = ?', (year, month)):
-      days.add(str(row[0]))
-    conn.close()
+    with self._Connection() as conn:
+      cursor = conn.cursor()
+      days = set([])
+      for row in cursor.execute(
+          'SELECT day FROM date_counts WHERE year = ? AND month = ?',
+          (year, month)):
+        days.add(str(row[0]))
+      cursor.close()
     return days
 
   def ListPhotosByYear(self, year):
-    cached = self._GetCache(year)
+    cached, generation = self._GetCache(('year', year))
     if cached:
       return cached
-    conn = sqlite3.connect(self.db_path)
-    cursor = conn.cursor()
-    photos = []
-    for row in cursor.execute(
-        '''SELECT id FROM files
-        WHERE year = ?
-        ORDER BY datetime ASC''', (year,)):
-      photos.append(row[0])
-    conn.close()
-    self._SetCache(year, photos)
+    with self._Connection() as conn:
+      cursor = conn.cursor()
+      photos = []
+      # month and day come from datetime, ordering by them as well gives the
+      # same order straight from the date index
+      for row in cursor.execute(
+          '''SELECT id FROM files
+          WHERE year = ?
+          ORDER BY month, day, datetime, id''', (year,)):
+        photos.append(row[0])
+      cursor.close()
+    self._SetCache(('year', year), photos, generation, [('year', year)])
     return photos
 
   def ListPhotosByMonth(self, year, month):
-    conn = sqlite3.connect(self.db_path)
-    cursor = conn.cursor()
-    photos = []
-    for row in cursor.execute(
-        '''SELECT id FROM files
-        WHERE year = ? AND month = ?
-        ORDER BY datetime ASC''', (year,month)):
-      photos.append(row[0])
-    conn.close()
+    with self._Connection() as conn:
+      cursor = conn.cursor()
+      photos = []
+      for row in cursor.execute(
+          '''SELECT id FROM files
+          WHERE year = ? AND month = ?
+          ORDER BY day, datetime, id''', (year, month)):
+        photos.append(row[0])
+      cursor.close()
     return photos
 
   def ListPhotos(self, year, month, day):
-    conn = sqlite3.connect(self.db_path)
-    cursor = conn.cursor()
-    photos = []
-    for row in cursor.execute(
-        '''SELECT id FROM files
-        WHERE year = ? AND month = ? AND day = ?
-        ORDER BY datetime ASC''', (year, month, day)):
-      photos.append(row[0])
-    conn.close()
+    with self._Connection() as conn:
+      cursor = conn.cursor()
+      photos = []
+      for row in cursor.execute(
+          '''SELECT id FROM files
+          WHERE year = ? AND month = ? AND day = ?
+          ORDER BY datetime, id''', (year, month, day)):
+        photos.append(row[0])
+      cursor.close()
     return photos
 
   def GetRealPhotoPath(self, photo_id):
-    conn = sqlite3.connect(self.db_path)
-    cursor = conn.cursor()
-    cursor.execute(
-        '''SELECT path FROM files WHERE id = ?''', (photo_id,))
-    result = cursor.fetchone()
-    conn.close()
+    with self._Connection() as conn:
+      cursor = conn.cursor()
+      cursor.execute(
+          '''SELECT path FROM files WHERE id = ?''', (photo_id,))
+      result = cursor.fetchone()
+      cursor.close()
+    if result:
+      return result[0]
+    return None
+
+  def GetPhotoDate(self, photo_id):
+    '''Returns when a photo was taken as YYYYMMDDHHMMSS.'''
+    with self._Connection() as conn:
+      cursor = conn.cursor()
+      cursor.execute(
+          '''SELECT datetime FROM files WHERE id = ?''', (photo_id,))
+      result = cursor.fetchone()
+      cursor.close()
     if result:
       return result[0]
     return None
 
   def GetLabels(self):
-    cached = self._GetCache('labels')
+    cached, generation = self._GetCache('labels')
     if cached:
       return cached
-    conn = sqlite3.connect(self.db_path)
-    cursor = conn.cursor()
-    labels = set([])
-    for row in cursor.execute('SELECT label FROM files'):
-      labels.add(str(row[0]))
-    conn.close()
-    self._SetCache('labels', labels)
+    with self._Connection() as conn:
+      cursor = conn.cursor()
+      labels = set([])
+      for row in cursor.execute('SELECT label FROM label_counts'):
+        labels.add(str(row[0]))
+      cursor.close()
+    self._SetCache('labels', labels, generation)
     return labels
 
   def GetTags(self):
-    cached = self._GetCache('tags')
+    cached, generation = self._GetCache('tags')
     if cached:
       return cached
-    conn = sqlite3.connect(self.db_path)
-    cursor = conn.cursor()
-    tags = set([])
-    for row in cursor.execute('SELECT tag FROM files_tags'):
-      tags.add(str(row[0]))
-    conn.close()
-    self._SetCache('tags', tags)
+    with self._Connection() as conn:
+      cursor = conn.cursor()
+      tags = set([])
+      for row in cursor.execute('SELECT tag FROM tag_counts'):
+        tags.add(str(row[0]))
+      cursor.close()
+    self._SetCache('tags', tags, generation)
     return tags
 
   def ListPhotosByLabel(self, label):
-    conn = sqlite3.connect(self.db_path)
-    cursor = conn.cursor()
-    photos = []
-    for row in cursor.execute(
-        '''SELECT id FROM files WHERE label = ? ORDER BY datetime ASC''',
-        (label,)):
-      photos.append(row[0])
-    conn.close()
+    with self._Connection() as conn:
+      cursor = conn.cursor()
+      photos = []
+      for row in cursor.execute(
+          '''SELECT id FROM files WHERE label = ? ORDER BY datetime, id''',
+          (label,)):
+        photos.append(row[0])
+      cursor.close()
     return photos
 
   def ListSelectsByLabel(self, select_tag, label):
-    conn = sqlite3.connect(self.db_path)
-    cursor = conn.cursor()
-    photos = []
-    for row in cursor.execute(
-        '''SELECT files.id FROM files, files_tags WHERE label = ? AND
-        files_tags.tag = ? AND files_tags.files_rowid == files.id
-        ORDER BY files.datetime ASC''',
-        (label, select_tag)):
-      photos.append(row[0])
-    conn.close()
+    with self._Connection() as conn:
+      cursor = conn.cursor()
+      photos = []
+      for row in cursor.execute(
+          '''SELECT id FROM files WHERE label = ? AND EXISTS (
+            SELECT 1 FROM files_tags WHERE tag = ? AND files_rowid = files.id)
+          ORDER BY datetime, id''',
+          (label, select_tag)):
+        photos.append(row[0])
+      cursor.close()
     return photos
 
   def ListPhotosByTags(self, tags):
-    conn = sqlite3.connect(self.db_path)
-    cursor = conn.cursor()
-    photos = []
-    for row in cursor.execute(
-        '''SELECT files_rowid FROM files_tags
-        WHERE tag IN (%s) GROUP BY files_rowid HAVING COUNT(files_rowid) = %d
-        ORDER BY datetime ASC''' % (
-            ','.join('?' * len(tags)), len(tags)), tags):
-      photos.append(row[0])
-    conn.close()
+    with self._Connection() as conn:
+      cursor = conn.cursor()
+      photos = []
+      for row in cursor.execute(
+          '''SELECT id FROM files WHERE id IN (
+            SELECT files_rowid FROM files_tags WHERE tag IN (%s)
+            GROUP BY files_rowid HAVING COUNT(files_rowid) = %d)
+          ORDER BY datetime, id''' % (
+              ','.join('?' * len(tags)), len(tags)), tags):
+        photos.append(row[0])
+      cursor.close()
     return photos
 
+  def GetRelatedTags(self, tags):
+    '''Returns the other tags of the photos having all of the given tags.'''
+    with self._Connection() as conn:
+      cursor = conn.cursor()
+      related = set([])
+      for row in cursor.execute(
+          '''SELECT DISTINCT tag FROM files_tags WHERE files_rowid IN (
+            SELECT files_rowid FROM files_tags WHERE tag IN (%s)
+            GROUP BY files_rowid HAVING COUNT(files_rowid) = %d)''' % (
+              ','.join('?' * len(tags)), len(tags)), tags):
+        related.add(str(row[0]))
+      cursor.close()
+    return related.difference(tags)
+
+  def GetAllPhotoTags(self):
+    '''Returns (tag, id) pairs for every tag of every photo.'''
+    with self._Connection() as conn:
+      cursor = conn.cursor()
+      tags = cursor.execute(
+          'SELECT tag, files_rowid FROM files_tags').fetchall()
+      cursor.close()
+    return tags
+
+  def LoadTagIndex(self):
+    '''Returns {tag: set of ids} saved by SaveTagIndex.
+
+    Returns None if photos were written since the index was last saved.
+    '''
+    self.write_lock.acquire()
+    try:
+      with self._Connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('SELECT name, value FROM counters')
+        counters = dict(cursor.fetchall())
+        if counters['tag_index'] != counters['changes']:
+          cursor.close()
+          return None
+        postings = {}
+        for row in cursor.execute('SELECT tag, ids FROM tag_index'):
+          ids = array(self._TAG_INDEX_TYPECODE)
+          ids.fromstring(str(row[1]))
+          # array items are longs, ids are formatted into file names
+          postings[str(row[0])] = set(int(i) for i in ids)
+        cursor.close()
+      return postings
+    finally:
+      self.write_lock.release()
+
+  def SaveTagIndex(self, pop_changes, replace=False):
+    '''Persists tag postings.
+
+    pop_changes is called with writes blocked and returns {tag: set of ids}
+    for the tags changed since the last save, an empty set for tags that
+    are gone. With replace the postings saved before are dropped, pass it
+    when all postings were rebuilt as tags may have gone since.
+    '''
+    self.write_lock.acquire()
+    try:
+      changes = pop_changes()
+      with self._Connection() as conn:
+        with conn:
+          cursor = conn.cursor()
+          if replace:
+            cursor.execute('DELETE FROM tag_index')
+          for tag, ids in changes.iteritems():
+            if ids:
+              cursor.execute(
+                  'INSERT OR REPLACE INTO tag_index VALUES(?, ?)',
+                  (tag, buffer(
+                      array(self._TAG_INDEX_TYPECODE, ids).tostring())))
+            else:
+              cursor.execute('DELETE FROM tag_index WHERE tag = ?', (tag,))
+          cursor.execute(
+              '''UPDATE counters SET value = (
+              SELECT value FROM counters WHERE name = 'changes')
+              WHERE name = ?''', ('tag_index',))
+        cursor.close()
+    finally:
+      self.write_lock.release()
+
   def DeletePhoto(self, photo_path):
-    conn = sqlite3.connect(self.db_path)
-    cursor = conn.cursor()
-    cursor.execute('DELETE FROM files WHERE path = ?', (photo_path,))
-    cursor.execute('DELETE FROM files_tags WHERE path = ?', (photo_path,))
-    conn.commit()
-    conn.close()
-    self._EmptyCache()
+    self.WriteBatch([], [], [photo_path])
 
   def HasPhoto(self, photo_path):
-    conn = sqlite3.connect(self.db_path)
-    cursor = conn.cursor()
-    cursor.execute('SELECT id FROM files WHERE path = ?', (photo_path,))
-    result = cursor.fetchone()
-    conn.close()
+    with self._Connection() as conn:
+      cursor = conn.cursor()
+      cursor.execute('SELECT id FROM files WHERE path = ?', (photo_path,))
+      result = cursor.fetchone()
+      cursor.close()
     return result != None
 
-  def GetConfValues(self, conf):
-    conn = sqlite3.connect(self.db_path)
-    cursor = conn.cursor()
-    values = set([])
-    for row in cursor.execute('SELECT `{0}` FROM files'.format(conf)):
-      if row[0]:
-        values.add(str(row[0]))
-    conn.close()
-    return values
+  def GetConfValues(self, conf, confs=(), values=()):
+    '''Returns values of conf among photos matching confs = values.'''
+    with self._Connection() as conn:
+      cursor = conn.cursor()
+      where = ''
+      if confs:
+        where = 'WHERE ' + ' AND '.join(['%s = ?' % c for c in confs])
+      conf_values = set([])
+      for row in cursor.execute(
+          'SELECT DISTINCT `{0}` FROM files {1}'.format(conf, where), values):
+        if row[0]:
+          conf_values.add(str(row[0]))
+      cursor.close()
+    return conf_values
 
   def IsConfValueValid(self, conf, value):
-    conn = sqlite3.connect(self.db_path)
-    cursor = conn.cursor()
-    cursor.execute('SELECT id FROM files WHERE {0} = ?'.format(conf), (value,))
-    result = cursor.fetchone()
-    conn.close()
+    with self._Connection() as conn:
+      cursor = conn.cursor()
+      cursor.execute(
+          'SELECT id FROM files WHERE {0} = ?'.format(conf), (value,))
+      result = cursor.fetchone()
+      cursor.close()
     return result != None
 
   def ListPhotosByConf(self, confs, values):
-    conn = sqlite3.connect(self.db_path)
-    cursor = conn.cursor()
-    photos = []
-    for row in cursor.execute(
-        '''SELECT id FROM files WHERE {0} ORDER BY datetime ASC'''.format(
-            ' AND '.join(['%s = ?' % c for c in confs])), values):
-      photos.append(row[0])
-    conn.close()
+    with self._Connection() as conn:
+      cursor = conn.cursor()
+      photos = []
+      for row in cursor.execute(
+          '''SELECT id FROM files WHERE {0} ORDER BY datetime, id'''.format(
+              ' AND '.join(['%s = ?' % c for c in confs])), values):
+        photos.append(row[0])
+      cursor.close()
+    return photos
+
+  def GetAllPhotoConfs(self, confs):
+    '''Returns (id, datetime, <values of confs>) of all photos.'''
+    with self._Connection() as conn:
+      cursor = conn.cursor()
+      photos = cursor.execute('SELECT id, datetime, %s FROM files' %
+                              ', '.join(['`%s`' % c for c in confs])).fetchall()
+      cursor.close()
     return photos
 
   def GetAllPhotosLastModified(self):
-    conn = sqlite3.connect(self.db_path)
-    cursor = conn.cursor()
-    photos = {}
-    for row in cursor.execute('SELECT path, last_modified FROM files'):
-      photos[row[0]] = row[1]
-    conn.close()
+    '''Returns a dict mapping photo paths to (last_modified, size).'''
+    with self._Connection() as conn:
+      cursor = conn.cursor()
+      photos = {}
+      for row in cursor.execute('SELECT path, last_modified, size FROM files'):
+        photos[row[0]] = (row[1], row[2])
+      cursor.close()
     return photos
 
+  def GetAllPhotoDates(self):
+    '''Returns (id, path, datetime, year, month, day, label) of all photos.'''
+    with self._Connection() as conn:
+      cursor = conn.cursor()
+      photos = cursor.execute(
+          'SELECT id, path, datetime, year, month, day, label FROM files'
+          ).fetchall()
+      cursor.close()
+    return photos
+
+  def GetPhotosLastModified(self, paths):
+    '''Same as GetAllPhotosLastModified but only for the given paths.'''
+    with self._Connection() as conn:
+      cursor = conn.cursor()
+      photos = {}
+      paths = list(paths)
+      for i in xrange(0, len(paths), self._MAX_QUERY_PARAMS):
+        chunk = paths[i:i + self._MAX_QUERY_PARAMS]
+        for row in cursor.execute(
+            'SELECT path, last_modified, size FROM files WHERE path IN (%s)' %
+            ','.join('?' * len(chunk)), chunk):
+          photos[row[0]] = (row[1], row[2])
+      cursor.close()
+    return photos
+
+  def GetPhotosLastModifiedUnder(self, dirname):
+    '''Same as GetAllPhotosLastModified but only for photos below dirname.'''
+    with self._Connection() as conn:
+      cursor = conn.cursor()
+      photos = {}
+      for row in cursor.execute(
+          '''SELECT path, last_modified, size FROM files
+          WHERE path >= ? AND path < ?''', self._PrefixRange(dirname)):
+        photos[row[0]] = (row[1], row[2])
+      cursor.close()
+    return photos
+
+  def GetDirManifest(self, dirname):
+    '''Returns (mtime, subdirs, filenames) last recorded for dirname.'''
+    with self._Connection() as conn:
+      cursor = conn.cursor()
+      cursor.execute(
+          'SELECT mtime, subdirs, files FROM dirs WHERE path = ?', (dirname,))
+      result = cursor.fetchone()
+      cursor.close()
+    if result:
+      return result[0], self._SplitNames(result[1]), self._SplitNames(result[2])
+    return None
+
+  def WriteDirManifests(self, manifests, deleted_dirs):
+    '''Records directory listings, forgets deleted directory sub-trees.
+
+    manifests is a list of (dirname, mtime, subdirs, filenames) tuples. Only
+    call this once the photos of those directories have been written, a
+    recorded manifest makes the next resync skip the directory.
+    '''
+    with self._Connection() as conn:
+      with conn:
+        cursor = conn.cursor()
+        for dirname in deleted_dirs:
+          cursor.execute('DELETE FROM dirs WHERE path = ?', (dirname,))
+          cursor.execute(
+              'DELETE FROM dirs WHERE path >= ? AND path < ?',
+              self._PrefixRange(dirname))
+        cursor.executemany(
+            'INSERT OR REPLACE INTO dirs VALUES(?, ?, ?, ?, ?)',
+            [(dirname, mtime, len(subdirs) + len(filenames),
+              '/'.join(subdirs), '/'.join(filenames))
+             for dirname, mtime, subdirs, filenames in manifests])
+      cursor.close()
+
+  def _GetPhotoIds(self, cursor, paths):
+    ids = {}
+    for i in xrange(0, len(paths), self._MAX_QUERY_PARAMS):
+      chunk = paths[i:i + self._MAX_QUERY_PARAMS]
+      for row in cursor.execute(
+          'SELECT path, id FROM files WHERE path IN (%s)' %
+          ','.join('?' * len(chunk)), chunk):
+        ids[row[0]] = row[1]
+    return ids
+
+  def _GetCachedValues(self, cursor, paths):
+    '''Returns years, dates, labels and tags the photos at paths have.'''
+    values = {'year': set(), 'date': set(), 'label': set(), 'tag': set()}
+    for i in xrange(0, len(paths), self._MAX_QUERY_PARAMS):
+      chunk = paths[i:i + self._MAX_QUERY_PARAMS]
+      placeholders = ','.join('?' * len(chunk))
+      for row in cursor.execute(
+          '''SELECT year, month, day, label FROM files
+          WHERE path IN (%s)''' % placeholders, chunk):
+        values['year'].add(str(row[0]))
+        values['date'].add((str(row[0]), str(row[1]), str(row[2])))
+        if row[3] is not None:
+          values['label'].add(str(row[3]))
+      for row in cursor.execute(
+          '''SELECT DISTINCT tag FROM files_tags WHERE files_rowid IN (
+          SELECT id FROM files WHERE path IN (%s))''' % placeholders,
+          chunk):
+        values['tag'].add(str(row[0]))
+    return values
+
+  def _GetChanges(self):
+    with self._Connection() as conn:
+      cursor = conn.cursor()
+      cursor.execute("SELECT value FROM counters WHERE name = 'changes'")
+      changes = cursor.fetchone()[0]
+      cursor.close()
+    return changes
+
+  def _PollChanges(self):
+    try:
+      changes = self._GetChanges()
+      if changes != self.changes:
+        # read first, writes made while reloading show up at the next poll
+        logged = self._ReadChangesLog(self.changes, changes)
+        self.changes = changes
+        self.last_change = int(time())
+        self.cache_lock.acquire()
+        self.cache_generation += 1
+        self.cache_stats['evictions'] += len(self.cache)
+        self.cache = {}
+        self.cache_lock.release()
+        if logged:
+          photos, removed, folders = logged
+          self._TouchFolders(folders)
+          for listener in self.listeners:
+            listener.OnPhotosChanged(photos, removed)
+        else:
+          logging.info('Missed writes to the index, reloading it')
+          self.loaded = self.last_change
+          self.folder_changes = {}
+          for listener in self.listeners:
+            listener.OnIndexChanged()
+    except Exception, e:
+      logging.error('Failed checking the index for changes')
+      logging.exception(e)
+    self.FollowChanges()
+
+  def _LogChange(self, cursor, photos, removed, folders):
+    '''Logs the photos and folders a write touched, drops the oldest writes.
+
+    Called after the 'changes' counter was increased for the write.
+    '''
+    change = cursor.execute(
+        'SELECT value FROM counters WHERE name = ?', ('changes',)).fetchone()[0]
+    cursor.executemany(
+        'INSERT INTO changes_log VALUES(?, ?, ?, ?)',
+        [(change, p['id'], p['path'], 0) for p in photos] +
+        [(change, p['id'], p['path'], 1) for p in removed])
+    cursor.executemany(
+        'INSERT INTO changes_folders VALUES(?, ?)',
+        [(change, '/'.join(key)) for key in folders])
+    trimmed = change - self._CHANGES_LOG_SIZE
+    if trimmed > 0:
+      cursor.execute('DELETE FROM changes_log WHERE change <= ?', (trimmed,))
+      cursor.execute(
+          'DELETE FROM changes_folders WHERE change <= ?', (trimmed,))
+      cursor.execute(
+          'UPDATE counters SET value = MAX(value, ?) WHERE name = ?',
+          (trimmed, 'changes_log'))
+
+  def _ReadChangesLog(self, since, until):
+    '''Returns (photos, removed, folders) written after since up to until.
+
+    photos and removed are as passed to OnPhotosChanged, folders are keys
+    of GetLastChange. Returns None if the log no longer has those writes.
+    '''
+    with self._Connection() as conn:
+      cursor = conn.cursor()
+      entries = cursor.execute(
+          '''SELECT files_rowid, path, removed FROM changes_log
+          WHERE change > ? AND change <= ? ORDER BY change''',
+          (since, until)).fetchall()
+      folders = set(tuple(row[0].split('/')) for row in cursor.execute(
+          'SELECT folder FROM changes_folders WHERE change > ? AND change <= ?',
+          (since, until)))
+      # writes are trimmed oldest first, so if since wasn't trimmed after
+      # reading the log, nothing it should have returned was missing
+      cursor.execute(
+          'SELECT value FROM counters WHERE name = ?', ('changes_log',))
+      if since < cursor.fetchone()[0]:
+        cursor.close()
+        return None
+      removed = OrderedDict(
+          (photo_id, {'id': photo_id, 'path': path})
+          for photo_id, path, is_removed in entries if is_removed)
+      # photos removed since aren't found, they are in removed as well
+      photos = self._GetPhotos(cursor, list(OrderedDict.fromkeys(
+          photo_id for photo_id, _path, is_removed in entries
+          if not is_removed)))
+      cursor.close()
+    return photos, removed.values(), folders
+
+  def _GetPhotos(self, cursor, ids):
+    '''Returns meta-data dicts of photos with their 'id' and 'tags'.'''
+    photos = OrderedDict()
+    for i in xrange(0, len(ids), self._MAX_QUERY_PARAMS):
+      chunk = ids[i:i + self._MAX_QUERY_PARAMS]
+      placeholders = ','.join('?' * len(chunk))
+      for row in cursor.execute(
+          'SELECT id, %s FROM files WHERE id IN (%s)' % (
+              ', '.join('`%s`' % c for c in self._COLUMNS), placeholders),
+          chunk):
+        photos[row[0]] = dict(zip(self._COLUMNS, row[1:]), id=row[0], tags=[])
+      for row in cursor.execute(
+          'SELECT files_rowid, tag FROM files_tags WHERE files_rowid IN (%s)'
+          % placeholders, chunk):
+        if row[0] in photos:
+          photos[row[0]]['tags'].append(str(row[1]))
+    return photos.values()
+
+  def _PrefixRange(self, dirname):
+    # '0' sorts right after '/', so this selects everything below dirname
+    return dirname + '/', dirname + '0'
+
+  def _SplitNames(self, value):
+    # names can't contain '/' which makes it a safe separator
+    if value:
+      return value.split('/')
+    return []
+
   def _CreateConfFolder(self):
-    if not os.path.isdir(self._CONF_DIR):
-      os.makedirs(self._CONF_DIR)
+    if not os.path.isdir(self.index_dir):
+      os.makedirs(self.index_dir)
 
   def _GenerateDbId(self, path):
     abs_path = os.path.abspath(path)
     return hashlib.md5(abs_path).hexdigest()
 
+  @contextmanager
+  def _Connection(self):
+    '''Lends a connection from the pool for the duration of a with block.
+
+    FUSE callbacks come from libfuse threads that python sees as a new
+    thread on every call, so connections are shared between threads
+    instead of being kept per thread. Each one is used by a single thread
+    at a time and keeps its prepared statements while it sits in the pool.
+    '''
+    try:
+      conn = self.pool.get_nowait()
+    except Queue.Empty:
+      conn = None
+      self.pool_lock.acquire()
+      can_open = self.pool_size < self._MAX_CONNECTIONS
+      if can_open:
+        self.pool_size += 1
+      self.pool_lock.release()
+      if can_open:
+        try:
+          conn = self._Connect()
+        except:
+          self.pool_lock.acquire()
+          self.pool_size -= 1
+          self.pool_lock.release()
+          raise
+      else:
+        conn = self.pool.get()
+    try:
+      yield conn
+    finally:
+      self.pool.put(conn)
+
+  def _Connect(self):
+    conn = sqlite3.connect(
+        self.db_path,
+        timeout=self._BUSY_TIMEOUT_SEC,
+        cached_statements=self._CACHED_STATEMENTS,
+        check_same_thread=False)
+    if self.read_only:
+      conn.execute('PRAGMA query_only=ON')
+    else:
+      # WAL lets readers proceed while the indexer is writing
+      conn.execute('PRAGMA journal_mode=WAL')
+      conn.execute('PRAGMA synchronous=NORMAL')
+    return conn
+
+  def Close(self):
+    '''Closes the connections, waits for those in use to be returned.'''
+    self.pool_lock.acquire()
+    while self.pool_size:
+      self.pool.get().close()
+      self.pool_size -= 1
+    self.pool_lock.release()
+
   def _CreateTables(self):
-    conn = sqlite3.connect(self.db_path)
-    columns = ','.join(self._COLUMNS)
-    cursor = conn.cursor()
+    '''Creates the tables or migrates them to _SCHEMA_VERSION.
+
+    Every migration runs in a single transaction, an interrupted one leaves
+    the index as it was. Indexes written before the schema was versioned
+    have version 0, just like a new database.
+    '''
+    with self._Connection() as conn:
+      cursor = conn.cursor()
+      version = cursor.execute('PRAGMA user_version').fetchone()[0]
+      cursor.close()
+      if version > self._SCHEMA_VERSION:
+        raise RuntimeError('%s was written by a newer version of photofs' %
+                           self.db_path)
+      while version < self._SCHEMA_VERSION:
+        if version:
+          logging.info('Migrating index from schema version %d', version)
+        conn.isolation_level = None  # DDL would commit a pending transaction
+        cursor = conn.cursor()
+        cursor.execute('BEGIN IMMEDIATE')
+        try:
+          getattr(self, '_MigrateFromVersion%d' % version)(cursor)
+          version += 1
+          cursor.execute('PRAGMA user_version = %d' % version)
+          cursor.execute('COMMIT')
+        except:
+          cursor.execute('ROLLBACK')
+          raise
+        finally:
+          cursor.close()
+          conn.isolation_level = ''
+
+  def _MigrateFromVersion0(self, cursor):
+    '''Types the columns and replaces the per-column indexes.
+
+    The indexes are composite and cover the queries of the views: listing a
+    year, month or day, an album, the photos with a tag or a camera setting
+    reads a single index in the order photos are shown.
+    '''
+    legacy = cursor.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'files'"
+        ).fetchone()
+    if legacy:
+      cursor.execute('ALTER TABLE `files` RENAME TO `files_v0`')
+      cursor.execute('ALTER TABLE `files_tags` RENAME TO `files_tags_v0`')
+
     cursor.execute(
-        '''CREATE TABLE IF NOT EXISTS
-        `files_tags` (`path`, `tag`, `files_rowid`, `datetime`)''')
+        '''CREATE TABLE `files` (`id` INTEGER PRIMARY KEY AUTOINCREMENT,
+        `path` TEXT NOT NULL, `datetime` TEXT, `last_modified` TEXT,
+        `year` TEXT, `month` TEXT, `day` TEXT, `f` TEXT, `iso` TEXT,
+        `make` TEXT, `camera` TEXT, `focal_length` TEXT, `lens_model` TEXT,
+        `lens_spec` TEXT, `label` TEXT, `size` INTEGER)''')
     cursor.execute(
-        'CREATE INDEX IF NOT EXISTS `tags-path-index` ON `files_tags` (`path`)')
+        '''CREATE TABLE `files_tags` (`tag` TEXT NOT NULL,
+        `files_rowid` INTEGER NOT NULL, UNIQUE (`tag`, `files_rowid`))''')
+
+    if legacy:
+      # databases created by older versions lack the columns added since
+      existing_columns = set(
+          row[1] for row in cursor.execute('PRAGMA table_info(`files_v0`)'))
+      columns = ', '.join(
+          '`%s`' % c for c in self._COLUMNS if c in existing_columns)
+      # older versions could index a path twice, the last copy is kept
+      cursor.execute(
+          '''INSERT INTO `files` (`id`, %s) SELECT `id`, %s FROM `files_v0`
+          WHERE `id` IN (SELECT MAX(`id`) FROM `files_v0` GROUP BY `path`)'''
+          % (columns, columns))
+      cursor.execute(
+          '''INSERT OR IGNORE INTO `files_tags`
+          SELECT `tag`, `files_rowid` FROM `files_tags_v0`
+          WHERE `files_rowid` IN (SELECT `id` FROM `files`)''')
+      # ids of deleted photos must not be handed out again
+      cursor.execute(
+          '''UPDATE `sqlite_sequence` SET `seq` = (
+          SELECT `seq` FROM `sqlite_sequence` WHERE `name` = 'files_v0')
+          WHERE `name` = 'files' AND EXISTS (
+          SELECT 1 FROM `sqlite_sequence` WHERE `name` = 'files_v0')''')
+      cursor.execute('DROP TABLE `files_v0`')
+      cursor.execute('DROP TABLE `files_tags_v0`')
+
     cursor.execute(
-        'CREATE INDEX IF NOT EXISTS `tags-tags-index` ON `files_tags` (`tag`)')
+        '''CREATE INDEX `files-date-index`
+        ON `files` (`year`, `month`, `day`, `datetime`, `id`)''')
     cursor.execute(
-        '''CREATE INDEX IF NOT EXISTS
-        `tags-rowid-index` ON `files_tags` (`files_rowid`)''')
-
+        '''CREATE INDEX `files-label-index`
+        ON `files` (`label`, `datetime`, `id`)''')
     cursor.execute(
-        '''CREATE TABLE IF NOT EXISTS `files` (`id` INTEGER PRIMARY
-        KEY AUTOINCREMENT, %s)''' % columns)
-    for column in self._COLUMNS:
+        'CREATE UNIQUE INDEX `files-path-index` ON `files` (`path`)')
+    for column in self._CONF_COLUMNS:
       cursor.execute(
-          '''CREATE INDEX IF NOT EXISTS
-          `files-{0}-index` ON `files` (`{0}`)'''.format(column))
-    conn.commit()
-    conn.close()
+          '''CREATE INDEX `files-{0}-index`
+          ON `files` (`{0}`, `datetime`, `id`)'''.format(column))
+    cursor.execute(
+        '''CREATE INDEX `tags-photo-index`
+        ON `files_tags` (`files_rowid`, `tag`)''')
+
+    cursor.execute(
+        '''CREATE TABLE IF NOT EXISTS `dirs` (`path` PRIMARY KEY, `mtime`,
+        `entries`, `subdirs`, `files`)''')
+
+    # 'changes' counts writes, other counters record the value of 'changes'
+    # their persisted structure was saved at
+    cursor.execute(
+        'CREATE TABLE IF NOT EXISTS `counters` (`name` PRIMARY KEY, `value`)')
+    cursor.executemany(
+        'INSERT OR IGNORE INTO `counters` VALUES(?, ?)',
+        [('changes', 0), ('tag_index', -1)])
+    cursor.execute(
+        'CREATE TABLE IF NOT EXISTS `tag_index` (`tag` PRIMARY KEY, `ids` BLOB)')
+
+  def _MigrateFromVersion1(self, cursor):
+    '''Adds photo counts per day, label and tag kept by triggers.
+
+    Listing years, months, days, labels and tags then reads as many rows as
+    there are values instead of every photo.
+    '''
+    cursor.execute(
+        '''CREATE TABLE `date_counts` (`year` TEXT, `month` TEXT, `day` TEXT,
+        `photos` INTEGER NOT NULL, PRIMARY KEY (`year`, `month`, `day`))''')
+    cursor.execute(
+        '''CREATE TABLE `label_counts` (`label` TEXT PRIMARY KEY,
+        `photos` INTEGER NOT NULL)''')
+    cursor.execute(
+        '''CREATE TABLE `tag_counts` (`tag` TEXT PRIMARY KEY,
+        `photos` INTEGER NOT NULL)''')
+    cursor.execute(
+        '''INSERT INTO `date_counts`
+        SELECT `year`, `month`, `day`, COUNT(*) FROM `files`
+        GROUP BY `year`, `month`, `day`''')
+    cursor.execute(
+        '''INSERT INTO `label_counts`
+        SELECT `label`, COUNT(*) FROM `files` WHERE `label` IS NOT NULL
+        GROUP BY `label`''')
+    cursor.execute(
+        '''INSERT INTO `tag_counts`
+        SELECT `tag`, COUNT(*) FROM `files_tags` GROUP BY `tag`''')
+
+    add_date = '''INSERT OR IGNORE INTO `date_counts`
+        VALUES (new.`year`, new.`month`, new.`day`, 0);
+        UPDATE `date_counts` SET `photos` = `photos` + 1
+        WHERE `year` = new.`year` AND `month` = new.`month`
+        AND `day` = new.`day`;'''
+    remove_date = '''UPDATE `date_counts` SET `photos` = `photos` - 1
+        WHERE `year` = old.`year` AND `month` = old.`month`
+        AND `day` = old.`day`;
+        DELETE FROM `date_counts` WHERE `year` = old.`year`
+        AND `month` = old.`month` AND `day` = old.`day` AND `photos` <= 0;'''
+    # photos without a label aren't in any album
+    add_label = '''INSERT OR IGNORE INTO `label_counts`
+        SELECT new.`label`, 0 WHERE new.`label` IS NOT NULL;
+        UPDATE `label_counts` SET `photos` = `photos` + 1
+        WHERE `label` = new.`label`;'''
+    remove_label = '''UPDATE `label_counts` SET `photos` = `photos` - 1
+        WHERE `label` = old.`label`;
+        DELETE FROM `label_counts`
+        WHERE `label` = old.`label` AND `photos` <= 0;'''
+    add_tag = '''INSERT OR IGNORE INTO `tag_counts` VALUES (new.`tag`, 0);
+        UPDATE `tag_counts` SET `photos` = `photos` + 1
+        WHERE `tag` = new.`tag`;'''
+    remove_tag = '''UPDATE `tag_counts` SET `photos` = `photos` - 1
+        WHERE `tag` = old.`tag`;
+        DELETE FROM `tag_counts` WHERE `tag` = old.`tag` AND `photos` <= 0;'''
+    for name, event, body in [
+        ('files-insert', 'AFTER INSERT ON `files`', add_date + add_label),
+        ('files-delete', 'AFTER DELETE ON `files`', remove_date + remove_label),
+        ('files-update-date',
+         'AFTER UPDATE OF `year`, `month`, `day` ON `files`',
+         remove_date + add_date),
+        ('files-update-label', 'AFTER UPDATE OF `label` ON `files`',
+         remove_label + add_label),
+        ('tags-insert', 'AFTER INSERT ON `files_tags`', add_tag),
+        ('tags-delete', 'AFTER DELETE ON `files_tags`', remove_tag)]:
+      cursor.execute('CREATE TRIGGER `%s` %s BEGIN %s END' % (
+          name, event, body))
+
+  def _MigrateFromVersion2(self, cursor):
+    '''Adds a log of the photos and folders every write touched.
+
+    Read-only instances apply the writes of the locking instance from it
+    instead of reloading the whole index.
+    '''
+    cursor.execute(
+        '''CREATE TABLE `changes_log` (`change` INTEGER NOT NULL,
+        `files_rowid` INTEGER NOT NULL, `path` TEXT NOT NULL,
+        `removed` INTEGER NOT NULL)''')
+    cursor.execute(
+        'CREATE INDEX `changes-log-index` ON `changes_log` (`change`)')
+    cursor.execute(
+        '''CREATE TABLE `changes_folders` (`change` INTEGER NOT NULL,
+        `folder` TEXT NOT NULL)''')
+    cursor.execute(
+        'CREATE INDEX `changes-folders-index` ON `changes_folders` (`change`)')
+    # writes up to the value of 'changes_log' are no longer in the log
+    cursor.execute(
+        '''INSERT INTO `counters` SELECT ?, `value` FROM `counters`
+        WHERE `name` = ?''', ('changes_log', 'changes'))
+
+  def GetCacheStats(self):
+    self.cache_lock.acquire()
+    stats = dict(self.cache_stats)
+    stats['entries'] = len(self.cache)
+    self.cache_lock.release()
+    return stats
 
   def _GetCache(self, key):
+    '''Returns the cached value or None, and the generation to store with.'''
     self.cache_lock.acquire()
     if key in self.cache:
-      val = self.cache[key]
+      val = self.cache[key][0]
+      self.cache_stats['hits'] += 1
     else:
       val = None
+      self.cache_stats['misses'] += 1
+    generation = self.cache_generation
     self.cache_lock.release()
-    return val
+    return val, generation
+
+  def _SetCache(self, key, value, generation, deps=()):
+    '''Caches value until a write touches one of deps.
 
-  def _SetCache(self, key, value):
+    generation is the one _GetCache returned before value was queried, the
+    value isn't cached if a write was invalidated since as it may be stale.
+    deps are (kind, value) pairs such as ('year', '2009').
+    '''
     self.cache_lock.acquire()
-    self.cache[key] = value
+    if generation == self.cache_generation:
+      self.cache[key] = (value, frozenset(deps))
     self.cache_lock.release()
 
-  def _EmptyCache(self):
+  def _InvalidateCache(self, old_values, new_values):
+    '''Drops cache entries affected by a write.
+
+    old_values and new_values map each of year, label and tag to the set of
+    values the written photos had before and have after the write. Entries
+    depending on any of them are dropped; the lists of all years, labels and
+    tags only when a value may have disappeared or a new one appeared.
+    '''
+    touched = set()
+    for kind in self._CACHED_SETS:
+      for value in old_values[kind] | new_values[kind]:
+        touched.add((kind, value))
+
     self.cache_lock.acquire()
-    self.cache = {}
+    self.cache_generation += 1
+    for key, (value, deps) in self.cache.items():
+      if deps & touched:
+        del self.cache[key]
+        self.cache_stats['evictions'] += 1
+    for kind, key in self._CACHED_SETS.iteritems():
+      if key not in self.cache:
+        continue
+      removed = old_values[kind] - new_values[kind]
+      if removed or not new_values[kind].issubset(self.cache[key][0]):
+        del self.cache[key]
+        self.cache_stats['evictions'] += 1
     self.cache_lock.release()
 
+  def _GetFolders(self, values):
+    '''Returns GetLastChange keys of folders listing photos with values.'''
+    keys = set()
+    for year, month, day in values['date']:
+      keys.update([('year', year), ('month', year, month),
+                   ('day', year, month, day)])
+    keys.update(('label', label) for label in values['label'])
+    keys.update(('tag', tag) for tag in values['tag'])
+    return keys
+
+  def _TouchFolders(self, keys):
+    for key in keys:
+      self.folder_changes[key] = self.last_change
+
   def _PeriodicBuildCache(self):
     self.BuildCache()
     t = Timer(self._CACHE_REFRESH_MIN * 60, self._PeriodicBuildCache)
     t.daemon = True
     t.start()
 
-  def _HandleTags(self, cursor, tags, path, photo_datetime):
-    cursor.execute('SELECT id FROM files WHERE path = ?', (path,))
-    rowid = cursor.fetchone()[0]
-    for tag in tags:
-      tag_lower = tag.lower()
-      if tag_lower not in self.unique_tags:
-        self.unique_tags.add(tag_lower)
-      cursor.execute(
-          '''INSERT INTO files_tags VALUES(?, ?, ?, ?)''',
-          (path, tag_lower, rowid, photo_datetime))
+  def _HandleTags(self, cursor, metas):
+    rows = []
+    for meta in metas:
+      for tag in meta['tags'] or []:
+        tag_lower = tag.lower()
+        if tag_lower not in self.unique_tags:
+          self.unique_tags.add(tag_lower)
+        rows.append((tag_lower, meta['path']))
+    cursor.executemany(
+        '''INSERT OR IGNORE INTO files_tags SELECT ?, id FROM files
+        WHERE path = ?''', rows)
+
+
+class PhotoBatch(object):
+  '''Collects photo changes and writes them to PhotoDb in batches.
+
+  A batch is committed once it holds _BATCH_SIZE photos or once it has been
+  open for _BATCH_TIMEOUT_SEC, whichever comes first.
+  '''
+  _BATCH_SIZE = 500
+  _BATCH_TIMEOUT_SEC = 10
+
+  def __init__(self, db, size=_BATCH_SIZE, timeout=_BATCH_TIMEOUT_SEC):
+    self.db = db
+    self.size = size
+    self.timeout = timeout
+    self._Reset()
+
+  def Store(self, meta):
+    self.stored.append(meta)
+    self._MaybeFlush()
+
+  def Update(self, meta):
+    self.updated.append(meta)
+    self._MaybeFlush()
+
+  def Delete(self, path):
+    self.deleted.append(path)
+    self._MaybeFlush()
+
+  def Flush(self):
+    stored, updated, deleted = self.stored, self.updated, self.deleted
+    self._Reset()
+    self.db.WriteBatch(stored, updated, deleted)
+
+  def _MaybeFlush(self):
+    pending = len(self.stored) + len(self.updated) + len(self.deleted)
+    if pending >= self.size or time() - self.started >= self.timeout:
+      self.Flush()
+
+  def _Reset(self):
+    self.stored = []
+    self.updated = []
+    self.deleted = []
+    self.started = time()
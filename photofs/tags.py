@@ -0,0 +1,152 @@
+# -*- encoding: utf-8 -*-
+
+'''tags.py: keeps a posting list of photo ids for every tag in memory.'''
+
+__author__ = 'drseergio@gmail.com (Sergey Pisarenko)'
+
+import logging
+from threading import Lock, Timer
+
+
+class TagIndex(object):
+  '''Answers the tag queries of PhotoDb with set operations.
+
+  Drilling into tags/a/b/c intersects the posting sets of a, b and c
+  instead of grouping files_tags. The postings follow every write made
+  through PhotoDb and are saved back to the database periodically, so the
+  next mount doesn't have to rebuild them, unless the index is read-only.
+  Everything else is passed through to PhotoDb.
+  '''
+  _SAVE_INTERVAL_SEC = 60
+
+  def __init__(self, db):
+    self.db = db
+    self.lock = Lock()
+    # postings are tag -> ids, photo_tags the other way round
+    (self.dates, self.postings, self.photo_tags, self.dirty,
+     self.rebuilt) = self._Load()
+    db.AddListener(self)
+
+  def Start(self):
+    '''Saves the postings periodically, unless the index is read-only.'''
+    if not self.db.read_only:
+      self._ScheduleSave()
+
+  def __getattr__(self, name):
+    return getattr(self.db, name)
+
+  def GetTags(self):
+    self.lock.acquire()
+    tags = set(self.postings)
+    self.lock.release()
+    return tags
+
+  def ListPhotosByTags(self, tags):
+    self.lock.acquire()
+    photos = self._Intersect(tags)
+    photos = sorted(photos, key=lambda i: (self.dates.get(i), i))
+    self.lock.release()
+    return photos
+
+  def GetPhotoDate(self, photo_id):
+    return self.dates.get(photo_id)
+
+  def GetRelatedTags(self, tags):
+    self.lock.acquire()
+    photos = self._Intersect(tags)
+    related = set(t for t, ids in self.postings.iteritems()
+                  if t not in tags and not ids.isdisjoint(photos))
+    self.lock.release()
+    return related
+
+  def OnPhotosChanged(self, photos, removed):
+    self.lock.acquire()
+    for photo in photos + removed:
+      self._Remove(photo['id'])
+    for photo in photos:
+      self.dates[photo['id']] = photo['datetime']
+      tags = set(str(t.lower()) for t in photo['tags'] or [])
+      for tag in tags:
+        self.postings.setdefault(tag, set()).add(photo['id'])
+        self.dirty.add(tag)
+      if tags:
+        self.photo_tags[photo['id']] = tags
+    self.lock.release()
+
+  def OnIndexChanged(self):
+    loaded = self._Load()
+    self.lock.acquire()
+    (self.dates, self.postings, self.photo_tags, self.dirty,
+     self.rebuilt) = loaded
+    self.lock.release()
+
+  def Save(self):
+    if self.db.read_only:
+      return
+    popped = {}
+    def PopDirty():
+      popped.update(self._PopDirty())
+      return popped
+    # every tag is dirty after a rebuild, the saved ones may include others
+    rebuilt = self.rebuilt
+    try:
+      self.db.SaveTagIndex(PopDirty, rebuilt)
+      if rebuilt:
+        self.rebuilt = False
+    except Exception, e:
+      logging.error('Failed saving tag index')
+      logging.exception(e)
+      self.lock.acquire()
+      self.dirty.update(popped)
+      self.lock.release()
+
+  def _Load(self):
+    dates = dict((row[0], row[2]) for row in self.db.GetAllPhotoDates())
+    postings = self.db.LoadTagIndex()
+    if postings is None:
+      logging.info('Tag index is out of date, rebuilding it')
+      postings = {}
+      for tag, photo_id in self.db.GetAllPhotoTags():
+        postings.setdefault(str(tag), set()).add(photo_id)
+      dirty = set(postings)
+      rebuilt = True
+    else:
+      dirty = set()
+      rebuilt = False
+    photo_tags = {}
+    for tag, ids in postings.iteritems():
+      for photo_id in ids:
+        photo_tags.setdefault(photo_id, set()).add(tag)
+    return dates, postings, photo_tags, dirty, rebuilt
+
+  def _Intersect(self, tags):
+    postings = [self.postings.get(t, set()) for t in tags]
+    if not postings:
+      return set()
+    postings.sort(key=len)  # start from the most selective tag
+    return postings[0].intersection(*postings[1:])
+
+  def _Remove(self, photo_id):
+    self.dates.pop(photo_id, None)
+    for tag in self.photo_tags.pop(photo_id, ()):
+      ids = self.postings[tag]
+      ids.discard(photo_id)
+      self.dirty.add(tag)
+      if not ids:
+        del self.postings[tag]
+
+  def _PopDirty(self):
+    self.lock.acquire()
+    changes = dict((t, set(self.postings.get(t, ()))) for t in self.dirty)
+    self.dirty = set()
+    self.lock.release()
+    return changes
+
+  def _PeriodicSave(self):
+    self.Save()
+    self._ScheduleSave()
+
+  def _ScheduleSave(self):
+    t = Timer(self._SAVE_INTERVAL_SEC, self._PeriodicSave)
+    t.daemon = True
+    t.start()
@@ -0,0 +1,147 @@
+# -*- encoding: utf-8 -*-
+
+'''thumbs.py: keeps the previews embedded in photos in an on-disk cache.'''
+
+__author__ = 'drseergio@gmail.com (Sergey Pisarenko)'
+
+from collections import OrderedDict
+import logging
+import os
+import tempfile
+from threading import Lock
+
+from gi.repository import GExiv2
+
+
+class ThumbnailCache(object):
+  '''Extracts the EXIF previews of photos and keeps them in directory.
+
+  Previews are named after the photo id and mtime, so a changed photo never
+  gets a stale preview. The least recently used previews are removed once
+  they take more than max_bytes and the previews of photos PhotoDb reports
+  changed or deleted are removed right away.
+  '''
+  _MIN_WIDTH = 256  # smallest preview good enough for a thumbnail
+  _TMP_SUFFIX = '.tmp'
+
+  def __init__(self, db, file_cache, directory, max_bytes):
+    self.file_cache = file_cache
+    self.directory = directory
+    self.max_bytes = max_bytes
+    self.used_bytes = 0
+    self.lock = Lock()
+    self.entries = OrderedDict()  # file name -> size
+    self.names = {}  # photo id -> file name of its preview
+    self.missing = {}  # photo id -> file name the preview would have
+    self._LoadEntries()
+    db.AddListener(self)
+
+  def GetThumbnail(self, photo_id):
+    '''Returns the path of the preview of a photo or None if it has none.'''
+    cached = self.file_cache.GetStat(photo_id)
+    if not cached:
+      return None
+    real_path, real_stat = cached
+    name = '%x-%d' % (photo_id, int(real_stat.st_mtime))
+    path = os.path.join(self.directory, name)
+    self.lock.acquire()
+    if name in self.entries:
+      self.entries[name] = self.entries.pop(name)  # most recently used
+      self.lock.release()
+      return path
+    has_preview = self.missing.get(photo_id) != name
+    self.lock.release()
+    if not has_preview:
+      return None
+
+    data = self._Extract(real_path)
+    if data is None:
+      self.lock.acquire()
+      self.missing[photo_id] = name
+      self.lock.release()
+      return None
+    fd, tmp_path = tempfile.mkstemp(
+        suffix=self._TMP_SUFFIX, dir=self.directory)
+    os.write(fd, data)
+    os.close(fd)
+
+    self.lock.acquire()
+    self._Remove(photo_id)
+    os.rename(tmp_path, path)
+    self.entries[name] = len(data)
+    self.names[photo_id] = name
+    self.used_bytes += len(data)
+    while self.used_bytes > self.max_bytes and len(self.entries) > 1:
+      self._RemoveEntry(next(iter(self.entries)))
+    self.lock.release()
+    return path
+
+  def OnPhotosChanged(self, photos, removed):
+    self.lock.acquire()
+    for photo in photos + removed:
+      self._Remove(photo['id'])
+    self.lock.release()
+
+  def OnIndexChanged(self):
+    # changed photos never get a stale preview as names include the mtime,
+    # photos without one may be gone
+    self.lock.acquire()
+    self.missing = {}
+    self.lock.release()
+
+  def GetStats(self):
+    self.lock.acquire()
+    stats = {'entries': len(self.entries), 'bytes': self.used_bytes}
+    self.lock.release()
+    return stats
+
+  def _Extract(self, real_path):
+    try:
+      meta = GExiv2.Metadata(real_path)
+      previews = sorted(meta.get_preview_properties() or [],
+                        key=lambda p: p.get_width())
+      if not previews:
+        return None
+      large_enough = [p for p in previews if p.get_width() >= self._MIN_WIDTH]
+      preview = large_enough[0] if large_enough else previews[-1]
+      return meta.get_preview_image(preview).get_data()
+    except Exception, e:
+      logging.warning('Failed extracting preview of %s: %s', real_path, e)
+      return None
+
+  def _LoadEntries(self):
+    if not os.path.isdir(self.directory):
+      os.makedirs(self.directory)
+    found = []
+    for name in os.listdir(self.directory):
+      path = os.path.join(self.directory, name)
+      if name.endswith(self._TMP_SUFFIX):  # left by a crash
+        os.remove(path)
+        continue
+      st = os.stat(path)
+      found.append((st.st_atime, name, st.st_size))
+    for _atime, name, size in sorted(found):
+      self._Remove(self._GetPhotoId(name))  # older previews of the photo
+      self.entries[name] = size
+      self.names[self._GetPhotoId(name)] = name
+      self.used_bytes += size
+
+  def _Remove(self, photo_id):
+    '''Removes the preview of a photo, the caller holds lock.'''
+    self.missing.pop(photo_id, None)
+    name = self.names.get(photo_id)
+    if name:
+      self._RemoveEntry(name)
+
+  def _RemoveEntry(self, name):
+    self.used_bytes -= self.entries.pop(name)
+    photo_id = self._GetPhotoId(name)
+    if self.names.get(photo_id) == name:
+      del self.names[photo_id]
+    try:
+      os.remove(os.path.join(self.directory, name))
+    except OSError:
+      pass
+
+  def _GetPhotoId(self, name):
+    return int(name.split('-')[0], 16)
@@ -0,0 +1,168 @@
+# -*- encoding: utf-8 -*-
+
+'''tree.py: keeps the date and album hierarchies in memory.'''
+
+__author__ = 'drseergio@gmail.com (Sergey Pisarenko)'
+
+import bisect
+from threading import Lock
+
+
+class PhotoTree(object):
+  '''Answers the date and album queries of PhotoDb from memory.
+
+  The tree is loaded from the index once and then follows every write made
+  through PhotoDb, so listing directories never touches SQLite. Everything
+  it does not know about is passed through to PhotoDb.
+  '''
+  _SELECT_TAG = 'select'
+
+  def __init__(self, db):
+    self.db = db
+    self.lock = Lock()
+    self.photos = {}  # id -> (path, (datetime, id), keys of its directories)
+    self.path_ids = {}
+    self.dirs = {}  # key -> _TreeDir
+    self.children = {'years': set(), 'labels': set()}
+    self._Build()
+    db.AddListener(self)
+
+  def __getattr__(self, name):
+    return getattr(self.db, name)
+
+  def GetYears(self):
+    return self._GetChildren('years')
+
+  def GetMonths(self, year):
+    return self._GetChildren(('year', year))
+
+  def GetDays(self, year, month):
+    return self._GetChildren(('month', year, month))
+
+  def GetLabels(self):
+    return self._GetChildren('labels')
+
+  def ListPhotosByYear(self, year):
+    return self._ListPhotos(('year', year))
+
+  def ListPhotosByMonth(self, year, month):
+    return self._ListPhotos(('month', year, month))
+
+  def ListPhotos(self, year, month, day):
+    return self._ListPhotos(('day', year, month, day))
+
+  def ListPhotosByLabel(self, label):
+    return self._ListPhotos(('label', label))
+
+  def ListSelectsByLabel(self, select_tag, label):
+    if select_tag != self._SELECT_TAG:
+      return self.db.ListSelectsByLabel(select_tag, label)
+    return self._ListPhotos(('selects', label))
+
+  def GetRealPhotoPath(self, photo_id):
+    photo = self.photos.get(photo_id)
+    if photo:
+      return photo[0]
+    return None
+
+  def OnIndexChanged(self):
+    self._Build()
+
+  def OnPhotosChanged(self, photos, removed):
+    self.lock.acquire()
+    for photo in removed:
+      self._Remove(photo['path'])
+    for photo in photos:
+      self._Remove(photo['path'])
+      self._Add(photo['id'], photo['path'], photo['datetime'], photo['year'],
+                photo['month'], photo['day'], photo['label'],
+                self._SELECT_TAG in [t.lower() for t in photo['tags'] or []])
+    self.lock.release()
+
+  def _Build(self):
+    selects = set(self.db.ListPhotosByTags([self._SELECT_TAG]))
+    photos = self.db.GetAllPhotoDates()
+    self.lock.acquire()
+    self.photos = {}
+    self.path_ids = {}
+    self.dirs = {}
+    self.children = {'years': set(), 'labels': set()}
+    for photo_id, path, datetime, year, month, day, label in photos:
+      self._Add(photo_id, path, datetime, year, month, day, label,
+                photo_id in selects)
+    self.lock.release()
+
+  def _Add(self, photo_id, path, datetime, year, month, day, label,
+           is_select):
+    year, month, day = str(year), str(month), str(day)
+    keys = [('year', year), ('month', year, month), ('day', year, month, day)]
+    if label:
+      keys.append(('label', str(label)))
+      if is_select:
+        keys.append(('selects', str(label)))
+
+    entry = (datetime, photo_id)
+    for key in keys:
+      tree_dir = self.dirs.get(key)
+      if tree_dir is None:
+        tree_dir = self.dirs[key] = _TreeDir()
+        parent, name = self._GetParent(key)
+        if parent:
+          self.children.setdefault(parent, set()).add(name)
+      bisect.insort(tree_dir.entries, entry)
+      tree_dir.snapshot = None
+    self.photos[photo_id] = (path, entry, keys)
+    self.path_ids[path] = photo_id
+
+  def _Remove(self, path):
+    photo_id = self.path_ids.pop(path, None)
+    if photo_id is None:
+      return
+    _path, entry, keys = self.photos.pop(photo_id)
+    for key in keys:
+      tree_dir = self.dirs[key]
+      tree_dir.entries.remove(entry)
+      tree_dir.snapshot = None
+      if not tree_dir.entries:
+        del self.dirs[key]
+        parent, name = self._GetParent(key)
+        if parent:
+          self.children[parent].discard(name)
+          if not self.children[parent] and parent not in ('years', 'labels'):
+            del self.children[parent]
+
+  def _GetParent(self, key):
+    kind = key[0]
+    if kind == 'year':
+      return 'years', key[1]
+    if kind == 'month':
+      return ('year', key[1]), key[2]
+    if kind == 'day':
+      return ('month', key[1], key[2]), key[3]
+    if kind == 'label':
+      return 'labels', key[1]
+    return None, None
+
+  def _GetChildren(self, key):
+    self.lock.acquire()
+    children = set(self.children.get(key, ()))
+    self.lock.release()
+    return children
+
+  def _ListPhotos(self, key):
+    self.lock.acquire()
+    tree_dir = self.dirs.get(key)
+    if tree_dir is None:
+      photos = []
+    else:
+      if tree_dir.snapshot is None:
+        tree_dir.snapshot = [e[1] for e in tree_dir.entries]
+      photos = tree_dir.snapshot
+    self.lock.release()
+    return photos
+
+
+class _TreeDir(object):
+  def __init__(self):
+    self.entries = []  # (datetime, id) sorted the same way as the db does
+    self.snapshot = None  # list of ids handed out until entries change
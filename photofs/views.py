@@ -7,26 +7,43 @@ __author__ = 'drseergio@gmail.com (Sergey Pisarenko)'
 import fuse
 
 import calendar
+from collections import OrderedDict
 import errno
+import hashlib
 import inspect
 import os
 import re
 import shutil
 import stat
-import StringIO
 import sys
+from threading import Lock
 from time import time
 
 _VIEW_REGEX = re.compile(r'^_PhotoFs\w+View$')
+_PHOTO_INO = 1  # low bits of inode numbers tell what they belong to
+_THUMB_INO = 2
+_PATH_INO = 3
+NAMINGS = ('index', 'date')
 
 
 class _AbstractView(object):
-  _FILE_ID_REGEX = re.compile(r'^\d+\s\((0x\w+)\).jpg$')
-  _EXIV2_TMP_REGEX = re.compile(r'^\d+\s\((0x\w+)\).jpg(\d+)$')
-
-  def __init__(self, photo_db):
+  _INO_KIND = _PHOTO_INO
+  _LISTINGS = 16  # folders being read that are remembered between chunks
+  _LISTING_TIMEOUT_SEC = 60
+  # names of both namings: "0042 (0x1f).jpg" and "20120521-183012 (0x1f).jpg"
+  _FILE_ID_REGEX = re.compile(r'^[\d-]+\s\((0x\w+)\).jpg$')
+  _EXIV2_TMP_REGEX = re.compile(r'^[\d-]+\s\((0x\w+)\).jpg(\d+)$')
+
+  def __init__(self, photo_db, file_cache, handles, tmp_buffers, thumbs,
+               naming='index'):
     self.photo_db = photo_db
-    self.tmp_files = {}
+    self.file_cache = file_cache
+    self.handles = handles
+    self.tmp_buffers = tmp_buffers
+    self.thumbs = thumbs
+    self.naming = naming
+    self.listings = OrderedDict()  # path -> (time, entries)
+    self.listings_lock = Lock()
 
   '''Pretend that we can write to the folder.
 
@@ -34,33 +51,91 @@ class _AbstractView(object):
   over the original. This is to make qeytaks works transparently.
   '''
   def getattr(self, path_split):
-    if self._IsExiv2Tmp(path_split):
-      tmp_key = '/'.join(path_split)
-      if not tmp_key in self.tmp_files.keys():
-        self.tmp_files[tmp_key] = StringIO.StringIO()
-      st = FsStat()
+    real_path = self._GetExiv2TmpRealPath(path_split)
+    if real_path:
+      tmp_buffer = self.tmp_buffers.Get(self._GetTmpKey(path_split), real_path)
+      st = FsStat(GetPathIno(self._GetTmpKey(path_split)))
       st.st_nlink = 1
       st.st_mode = 33188
+      st.st_size = tmp_buffer.size
       return st
     return None
 
+  def readdir(self, path_split, offset):
+    '''Yields the entries of a folder from offset on.
+
+    The kernel reads large folders in chunks, each starting at the offset
+    the previous one stopped. The entries of the folder are listed when it's
+    read from the start and remembered for the following chunks, file names
+    are only formatted for the entries returned.
+    '''
+    entries = self._GetListing(path_split, offset)
+    for segment in entries:
+      if offset >= len(segment):
+        offset -= len(segment)
+        continue
+      if isinstance(segment, _PhotoNames):
+        for name in segment.IterFrom(offset):
+          yield name
+      else:
+        for name in segment[offset:]:
+          yield name
+      offset = 0
+
+  def _GetListing(self, path_split, offset):
+    key = tuple(path_split)
+    now = time()
+    self.listings_lock.acquire()
+    listing = self.listings.pop(key, None)
+    self.listings_lock.release()
+    if (offset == 0 or not listing or
+        now - listing[0] > self._LISTING_TIMEOUT_SEC):
+      listing = (now, self._List(path_split))
+    self.listings_lock.acquire()
+    self.listings[key] = listing
+    while len(self.listings) > self._LISTINGS:
+      self.listings.popitem(last=False)
+    self.listings_lock.release()
+    return listing[1]
+
+  def _List(self, path_split):
+    '''Returns the entries of a folder as a list of lists and _PhotoNames.'''
+    return []
+
+  def _GetPhotoNames(self, ids):
+    if self.naming == 'date':
+      return _DatedPhotoNames(ids, self.photo_db)
+    return _PhotoNames(ids)
+
   def open(self, path_split, flags):
-    if self._IsExiv2Tmp(path_split):
+    if self._GetTmpBuffer(path_split):
       return 0
     real_path = self._GetRealPath(path_split)
     if real_path:
-      return 0
+      try:
+        return self.handles.Open(real_path, flags)
+      except OSError, e:
+        return -e.errno
     return -errno.ENOENT
 
-  def read(self, path_split, length, offset):
+  def read(self, path_split, length, offset, fh=None):
+    if fh:
+      return fh.Read(length, offset)
+    tmp_buffer = self._GetTmpBuffer(path_split)
+    if tmp_buffer:
+      return tmp_buffer.Read(length, offset)
     fh = open(self._GetRealPath(path_split), 'r')
     fh.seek(offset)
-    return fh.read(length)
-
-  def write(self, path_split, buf, offset):
-    if self._IsExiv2Tmp(path_split):
-      tmp_key = '/'.join(path_split)
-      fh = self.tmp_files[tmp_key]
+    buf = fh.read(length)
+    fh.close()
+    return buf
+
+  def write(self, path_split, buf, offset, fh=None):
+    tmp_buffer = self._GetTmpBuffer(path_split)
+    if tmp_buffer:
+      return tmp_buffer.Write(buf, offset)
+    elif fh:
+      return fh.Write(buf, offset)
     else:
       fh = open(self._GetRealPath(path_split), 'a')
     fh.seek(offset)
@@ -68,74 +143,95 @@ class _AbstractView(object):
     return len(buf)
 
   def truncate(self, path_split, length):
-    if self._IsExiv2Tmp(path_split):
-      tmp_key = '/'.join(path_split)
-      fh = self.tmp_files[tmp_key]
-    else:
-      fh = open(self._GetRealPath(path_split), 'w+')
+    tmp_buffer = self._GetTmpBuffer(path_split)
+    if tmp_buffer:
+      return tmp_buffer.Truncate(length)
+    fh = open(self._GetRealPath(path_split), 'w+')
     return fh.truncate(length)
 
   def rename(self, oldPath_split, newPath_split):
-    if not self._IsExiv2Tmp(oldPath_split):
+    tmp_buffer = self.tmp_buffers.Pop(self._GetTmpKey(oldPath_split))
+    if not tmp_buffer:
       return 0
 
-    tmp_key = '/'.join(oldPath_split)
-    tmp_fh = self.tmp_files[tmp_key]
-
     real_path = self._GetRealPath(newPath_split)
-    real_fh = open(real_path, 'w')
-    real_fh.write(tmp_fh.getvalue())
-
-    real_fh.close()
-    tmp_fh.close()
-    del self.tmp_files[tmp_key]
+    if not real_path:
+      tmp_buffer.Discard()
+      return -errno.ENOENT
+    try:
+      tmp_buffer.Commit(real_path)
+    except (IOError, OSError), e:
+      tmp_buffer.Discard()
+      return -e.errno
+    # the cached stat is of the file replaced, don't wait for the watcher
+    self.file_cache.Invalidate(real_path)
     return 0
 
-  def release(self, path_split, flags):
+  def release(self, path_split, flags, fh=None):
+    if fh:
+      self.handles.Release(fh)
     return 0
 
   def unlink(self, path_split):
+    tmp_buffer = self.tmp_buffers.Pop(self._GetTmpKey(path_split))
+    if tmp_buffer:
+      tmp_buffer.Discard()
     return 0
 
   def _GetRealPath(self, path_split):
     match = self._FILE_ID_REGEX.match(path_split[-1])
     if match:
       photo_id = int(match.group(1), 16)
-      real_path = self.photo_db.GetRealPhotoPath(photo_id)
+      real_path = self.file_cache.GetRealPath(photo_id)
       return real_path
     return None
 
-  def _IsExiv2Tmp(self, path_split):
+  def _GetExiv2TmpRealPath(self, path_split):
+    '''Returns the real path of the photo a temp file of exiv2 replaces.'''
     match = self._EXIV2_TMP_REGEX.match(path_split[-1])
     if match:
       photo_id = int(match.group(1), 16)
-      real_path = self.photo_db.GetRealPhotoPath(photo_id)
-      if real_path:
-        return True
-    return False
+      return self.file_cache.GetRealPath(photo_id)
+    return None
+
+  def _GetTmpBuffer(self, path_split):
+    if not self._EXIV2_TMP_REGEX.match(path_split[-1]):
+      return None
+    return self.tmp_buffers.Get(self._GetTmpKey(path_split))
+
+  def _GetTmpKey(self, path_split):
+    return '%s/%s' % (self._NAME, '/'.join(path_split))
 
   def _GetRealFileStat(self, st, filename):
     match = self._FILE_ID_REGEX.match(filename)
     if match:
       photo_id = int(match.group(1), 16)
-      real_path = self.photo_db.GetRealPhotoPath(photo_id)
-      if real_path:
-        real_stat = os.stat(real_path)
-        st.st_mode = real_stat.st_mode
-        st.st_nlink = 1
-        st.st_uid = real_stat.st_uid
-        st.st_gid = real_stat.st_gid
-        st.st_size = real_stat.st_size
-        st.st_atime = real_stat.st_atime
-        st.st_mtime = real_stat.st_mtime
-        st.st_ctime = real_stat.st_ctime
-        return st
+      cached = self.file_cache.GetStat(photo_id)
+      if cached:
+        _real_path, real_stat = cached
+        return self._CopyFileStat(st, photo_id, real_stat)
     return None
 
-  def _FormatPhotoList(self, ids):
-    digits = len(str(len(ids)))
-    return ['%0{0}d (%s).jpg'.format(digits) % (i, hex(x))
-        for i, x in enumerate(ids, 1)]
+  def GetDirStat(self, path_split):
+    '''Returns the stat of a folder, it only changes with the index.'''
+    return FsStat(GetPathIno('/'.join([self._NAME] + path_split)),
+                  self._GetLastChange(path_split))
+
+  def _GetLastChange(self, path_split):
+    # views that can't tell which photos a folder lists change with any write
+    return self.photo_db.GetLastChange()
+
+  def _CopyFileStat(self, st, photo_id, real_stat):
+    st.st_ino = (photo_id << 2) | self._INO_KIND
+    st.st_mode = real_stat.st_mode
+    st.st_nlink = 1
+    st.st_uid = real_stat.st_uid
+    st.st_gid = real_stat.st_gid
+    st.st_size = real_stat.st_size
+    st.st_atime = real_stat.st_atime
+    st.st_mtime = real_stat.st_mtime
+    st.st_ctime = real_stat.st_ctime
+    return st
 
 
 class _PhotoFsDateView(_AbstractView):
@@ -146,7 +242,7 @@ class _PhotoFsDateView(_AbstractView):
     tmp = super(_PhotoFsDateView, self).getattr(path_split)
     if tmp:
       return tmp
-    st = FsStat()
+    st = self.GetDirStat(path_split)
 
     if len(path_split) == 1:
       years = self.photo_db.GetYears()
@@ -176,38 +272,100 @@ class _PhotoFsDateView(_AbstractView):
 
     return -errno.ENOENT
  
-  def readdir(self, path_split, _offset):
+  def _List(self, path_split):
     entries = []
 
     if not path_split:  # list years
-      entries.extend(self.photo_db.GetYears())
+      entries.append(sorted(self.photo_db.GetYears()))
     elif len(path_split) == 1:  # list months
       year = path_split[0]
-      entries.extend(self._FormatMonths(self.photo_db.GetMonths(year)))
-      entries.append(self._YEAR_ALL_FOLDER)
+      entries.append(self._FormatMonths(sorted(self.photo_db.GetMonths(year))))
+      entries.append([self._YEAR_ALL_FOLDER])
     elif len(path_split) == 2:
       year = path_split[0]
       if path_split[1] == self._YEAR_ALL_FOLDER:
-        entries.extend(
-            self._FormatPhotoList(self.photo_db.ListPhotosByYear(year)))
+        entries.append(
+            self._GetPhotoNames(self.photo_db.ListPhotosByYear(year)))
       else:  # list days
         month = path_split[1].split('-')[0]
-        entries.extend(self.photo_db.GetDays(year, month))
-        entries.extend(
-            self._FormatPhotoList(self.photo_db.ListPhotosByMonth(year,month)))
+        entries.append(sorted(self.photo_db.GetDays(year, month)))
+        entries.append(
+            self._GetPhotoNames(self.photo_db.ListPhotosByMonth(year, month)))
     elif len(path_split) == 3:  # list actual photos
       year = path_split[0]
       month = path_split[1].split('-')[0]
       day = path_split[2]
-      entries.extend(
-          self._FormatPhotoList(self.photo_db.ListPhotos(year, month, day)))
+      entries.append(
+          self._GetPhotoNames(self.photo_db.ListPhotos(year, month, day)))
 
     return entries
  
+  def _GetLastChange(self, path_split):
+    if not path_split:
+      return self.photo_db.GetLastChange()
+    year = path_split[0]
+    if len(path_split) == 1 or path_split[1] == self._YEAR_ALL_FOLDER:
+      return self.photo_db.GetLastChange('year', year)
+    month = path_split[1].split('-')[0]
+    if len(path_split) == 2:
+      return self.photo_db.GetLastChange('month', year, month)
+    return self.photo_db.GetLastChange('day', year, month, path_split[2])
+
   def _FormatMonths(self, months):
     return [str('%s-%s' % (m, calendar.month_abbr[int(m)])) for m in months]
 
 
+class _PhotoFsThumbsView(_PhotoFsDateView):
+  '''Same folders as the date view with the previews embedded in photos.
+
+  Photos without a preview are served as they are. The view is read-only.
+  '''
+  _NAME = 'thumbs'
+  _INO_KIND = _THUMB_INO
+
+  def open(self, path_split, flags):
+    if flags & (os.O_WRONLY | os.O_RDWR):
+      return -errno.EACCES
+    return super(_PhotoFsThumbsView, self).open(path_split, flags)
+
+  def write(self, path_split, buf, offset, fh=None):
+    return -errno.EACCES
+
+  def truncate(self, path_split, length):
+    return -errno.EACCES
+
+  def rename(self, oldPath_split, newPath_split):
+    return -errno.EACCES
+
+  def _GetRealPath(self, path_split):
+    match = self._FILE_ID_REGEX.match(path_split[-1])
+    if match:
+      return self._GetThumbnailPath(int(match.group(1), 16))
+    return None
+
+  def _GetRealFileStat(self, st, filename):
+    match = self._FILE_ID_REGEX.match(filename)
+    if match:
+      photo_id = int(match.group(1), 16)
+      path = self._GetThumbnailPath(photo_id)
+      if path:
+        try:
+          return self._CopyFileStat(st, photo_id, os.stat(path))
+        except OSError:
+          pass
+    return None
+
+  def _GetExiv2TmpRealPath(self, path_split):
+    return None  # previews can't be edited
+
+  def _GetTmpBuffer(self, path_split):
+    return None
+
+  def _GetThumbnailPath(self, photo_id):
+    return (self.thumbs.GetThumbnail(photo_id) or
+            self.file_cache.GetRealPath(photo_id))
+
+
 class _PhotoFsAlbumView(_AbstractView):
   _NAME = 'albums'
   _SELECTS_DIR = 'selects'
@@ -217,7 +375,7 @@ class _PhotoFsAlbumView(_AbstractView):
     tmp = super(_PhotoFsAlbumView, self).getattr(path_split)
     if tmp:
       return tmp
-    st = FsStat()
+    st = self.GetDirStat(path_split)
 
     if len(path_split) == 1:
       labels = self.photo_db.GetLabels()
@@ -236,22 +394,26 @@ class _PhotoFsAlbumView(_AbstractView):
 
     return -errno.ENOENT
 
-  def readdir(self, path_split, _offset):
+  def _List(self, path_split):
     entries = []
 
     if not path_split:  # list sets
-      entries.extend(self.photo_db.GetLabels())
+      entries.append(sorted(self.photo_db.GetLabels()))
     elif len(path_split) == 2:
-      entries.extend(
-          self._FormatPhotoList(self.photo_db.ListSelectsByLabel(
-              self._SELECTS_TAG, path_split[0])))
+      entries.append(self._GetPhotoNames(self.photo_db.ListSelectsByLabel(
+          self._SELECTS_TAG, path_split[0])))
     else:
-      entries.append(self._SELECTS_DIR)
-      entries.extend(
-          self._FormatPhotoList(self.photo_db.ListPhotosByLabel(path_split[0])))
+      entries.append([self._SELECTS_DIR])
+      entries.append(
+          self._GetPhotoNames(self.photo_db.ListPhotosByLabel(path_split[0])))
 
     return entries
 
+  def _GetLastChange(self, path_split):
+    if not path_split:
+      return self.photo_db.GetLastChange()
+    return self.photo_db.GetLastChange('label', path_split[0])
+
 
 class _PhotoFsTagsView(_AbstractView):
   _NAME = 'tags'
@@ -260,7 +422,7 @@ class _PhotoFsTagsView(_AbstractView):
     tmp = super(_PhotoFsTagsView, self).getattr(path_split)
     if tmp:
       return tmp
-    st = FsStat()
+    st = self.GetDirStat(path_split)
 
     tags = set(self.photo_db.GetTags())
     used_tags = path_split
@@ -275,21 +437,27 @@ class _PhotoFsTagsView(_AbstractView):
 
     return -errno.ENOENT
 
-  def readdir(self, path_split, _offset):
+  def _List(self, path_split):
     entries = []
 
-    tags = set(self.photo_db.GetTags())
     if not path_split:
-      entries.extend(tags)
+      entries.append(sorted(self.photo_db.GetTags()))
     else:
       used_tags = path_split
-      photos = self._FormatPhotoList(self.photo_db.ListPhotosByTags(used_tags))
+      photos = self.photo_db.ListPhotosByTags(used_tags)
       if photos:
-        entries.extend(tags.difference(used_tags))
-        entries.extend(photos)
+        # only tags that narrow the selection down further
+        entries.append(sorted(self.photo_db.GetRelatedTags(used_tags)))
+        entries.append(self._GetPhotoNames(photos))
 
     return entries
 
+  def _GetLastChange(self, path_split):
+    if not path_split:
+      return self.photo_db.GetLastChange()
+    # writing a photo listed here touches every one of these tags
+    return max(self.photo_db.GetLastChange('tag', t) for t in path_split)
+
 
 class _PhotoFsCameraView(_AbstractView):
   _NAME = 'camera'
@@ -300,7 +468,7 @@ class _PhotoFsCameraView(_AbstractView):
     tmp = super(_PhotoFsCameraView, self).getattr(path_split)
     if tmp:
       return tmp
-    st = FsStat()
+    st = self.GetDirStat(path_split)
 
     used_conf = path_split[::2]
 
@@ -317,42 +485,135 @@ class _PhotoFsCameraView(_AbstractView):
 
     return -errno.ENOENT
 
-  def readdir(self, path_split, _offset):
+  def _List(self, path_split):
     entries = []
 
     if not path_split:
-      entries.extend(self._PARAMS)
+      entries.append(sorted(self._PARAMS))
     else:
       if len(path_split) % 2 != 0 and path_split[-1] in self._PARAMS:
-        entries.extend(self.photo_db.GetConfValues(path_split[-1]))
+        # only values that still match photos under the parent folders
+        entries.append(sorted(self.photo_db.GetConfValues(
+            path_split[-1], path_split[:-1:2], path_split[1:-1:2])))
       else:
         used_conf = path_split[::2]
-        photos = self._FormatPhotoList(
-            self.photo_db.ListPhotosByConf(path_split[::2], path_split[1::2]))
+        photos = self.photo_db.ListPhotosByConf(
+            path_split[::2], path_split[1::2])
         if photos:
-          entries.extend(self._PARAMS.difference(used_conf))
-          entries.extend(photos)
+          entries.append(sorted(self._PARAMS.difference(used_conf)))
+          entries.append(self._GetPhotoNames(photos))
 
     return entries
 
 
+class _PhotoNames(object):
+  '''File names of a sorted list of photo ids, formatted when iterated.
+
+  Photos are numbered by their position, so a photo added to a folder
+  renames all photos after it.
+  '''
+
+  def __init__(self, ids):
+    self.ids = ids
+    self.format = '%0{0}d (%s).jpg'.format(len(str(len(ids))))
+
+  def __len__(self):
+    return len(self.ids)
+
+  def IterFrom(self, start):
+    for i in xrange(start, len(self.ids)):
+      yield self.format % (i + 1, hex(self.ids[i]))
+
+
+class _DatedPhotoNames(_PhotoNames):
+  '''Names photos after when they were taken and their id.
+
+  The name of a photo doesn't depend on the other photos in the folder, so
+  clients caching the folder only see the photos that changed.
+  '''
+
+  def __init__(self, ids, photo_db):
+    self.ids = ids
+    self.photo_db = photo_db
+
+  def IterFrom(self, start):
+    for i in xrange(start, len(self.ids)):
+      photo_id = self.ids[i]
+      taken = self.photo_db.GetPhotoDate(photo_id) or '0' * 14
+      yield '%s-%s (%s).jpg' % (taken[:8], taken[8:], hex(photo_id))
+
+
+class StatusFile(object):
+  '''A read-only file next to the views whose contents render() returns.
+
+  The contents are rendered again on every open and stay the same until the
+  file is released, so readers see a consistent snapshot.
+  '''
+
+  def __init__(self, name, render):
+    self.name = name
+    self.render = render
+
+  def getattr(self):
+    st = FsStat(GetPathIno(self.name))
+    st.st_mode = stat.S_IFREG | 0444
+    st.st_nlink = 1
+    st.st_size = len(self.render())
+    return st
+
+  def open(self, flags):
+    if flags & (os.O_WRONLY | os.O_RDWR):
+      return -errno.EACCES
+    return _StatusSnapshot(self.render())
+
+  def read(self, length, offset, fh=None):
+    if fh:
+      return fh.contents[offset:offset + length]
+    return self.render()[offset:offset + length]
+
+  def release(self, flags, fh=None):
+    return 0
+
+  def readdir(self, offset):
+    return -errno.ENOTDIR
+
+
+class _StatusSnapshot(object):
+  '''Contents of a status file as of open.
+
+  They are served uncached, the kernel would stop reading at the size
+  getattr returned earlier, which is that of another render.
+  '''
+  direct_io = True
+  keep_cache = False
+
+  def __init__(self, contents):
+    self.contents = contents
+
+
 class FsStat(fuse.Stat):
-  def __init__(self):
+  def __init__(self, ino=0, mtime=None):
     self.st_mode = stat.S_IFDIR | 0755
-    self.st_ino = 0
+    self.st_ino = ino
     self.st_dev = 0
     self.st_nlink = 2
     self.st_uid = 0
     self.st_gid = 0
     self.st_size = 4096
-    self.st_atime = int(time())
+    self.st_atime = int(time()) if mtime is None else mtime
     self.st_mtime = self.st_atime
     self.st_ctime = self.st_atime
 
 
-def GetViews(db): 
+def GetPathIno(path):
+  '''Returns a stable inode number for a virtual path.'''
+  return (int(hashlib.md5(path).hexdigest()[:15], 16) << 2) | _PATH_INO
+
+
+def GetViews(db, file_cache, handles, tmp_buffers, thumbs, naming='index'):
   views = {}
   for name, obj in inspect.getmembers(sys.modules[__name__]):
     if inspect.isclass(obj) and _VIEW_REGEX.match(name):
-      views[obj._NAME] = obj(db)
+      views[obj._NAME] = obj(
+          db, file_cache, handles, tmp_buffers, thumbs, naming)
   return views
@@ -5,7 +5,9 @@
 __author__ = 'drseergio@gmail.com (Sergey Pisarenko)'
 
 from datetime import datetime
+import itertools
 import logging
+import multiprocessing
 import os
 import sys
 import threading
@@ -18,15 +20,19 @@ except ImportError:
          'http://redmine.yorba.org/projects/gexiv2/wiki')
   sys.exit(1)
 
+from photofs.buffers import TMP_PREFIX
 from photofs.filters import escape
 from photofs.filters import filter_datetime
 from photofs.filters import filter_fnumber
 from photofs.filters import filter_label
 from photofs.filters import filter_lens_spec
+from photofs.storage import PhotoBatch
 
 
 class PhotoWalker(object):
   _SYNC_TIMEOUT = 60 * 30  # do sync in 30 minutes after start 
+  _WORKER_CHUNK_SIZE = 16  # paths handed to a metadata worker at once
+  _POOL_MIN_PATHS = 64  # fewer are parsed here, forking would take longer
   _METADATA_NAME_MAP = {
       'Exif.Photo.DateTimeOriginal': 'datetime',
       'Exif.Photo.FNumber': 'f',
@@ -42,44 +48,102 @@ class PhotoWalker(object):
       'Exif.Photo.LensSpecification': filter_lens_spec,
       'Xmp.xmp.Label': filter_label}
 
-  def __init__(self, path, db):
+  def __init__(self, path, db, workers=1):
     self.path = path
     self.db = db
+    self.workers = workers
+    self.lock = threading.Lock()
+    self.state = None  # of the current or the last walk
 
-  def Walk(self, existing_photo_dict={}):
-    existing_photos = existing_photo_dict.keys()
-    for dirname, _dirnames, filenames in os.walk(self.path, followlinks=True):
-      for filename in filenames:
-        full_path = os.path.realpath(os.path.join(dirname, filename))
-        try:
-          meta = self.ReadMetadata(full_path)
-        except Exception, e:
-          logging.error('Failed adding %s', full_path)
-          logging.exception(e)
-          continue
-
-        if full_path in existing_photos:
-          if self._GetLastModified(full_path) == existing_photo_dict[full_path]:
-            continue
-          else:
-            self.db.UpdatePhoto(full_path, meta)
-        else:
-          self.db.StorePhoto(full_path, meta)
+  def Walk(self, roots=None, count=False, full=False):
+    '''Brings the index in line with the files under the root path.
+
+    Every directory's listing is recorded together with its mtime. Adding,
+    removing or renaming an entry changes the mtime of a directory, so
+    directories whose mtime still matches are not listed again and only
+    their sub-directories are visited. In changed directories deletions are
+    found by diffing the listing and only new files or files whose stat does
+    not match the index are parsed.
+
+    roots limits the walk to some directories below the root path. With
+    count the files are counted in another thread first, so GetProgress can
+    estimate when the walk will finish. With full every directory is listed
+    and every file is stat'ed, as rewriting a file in place doesn't change
+    the mtime of its directory.
+    '''
+    self.lock.acquire()
+    try:
+      self._Walk(roots or [self.path], count, full)
+    finally:
+      if not self.state.finished:  # the walk failed
+        self.state.finished = time.time()
+      self.lock.release()
+
+  def GetProgress(self):
+    '''Returns counts, rate (files/s) and ETA (seconds) of the last walk.'''
+    state = self.state
+    if not state:
+      return {'walking': False}
+    progress = dict(state.counts)
+    progress['indexed'] = progress['parsed'] - progress['failed']
+    progress['total'] = state.total
+    progress['walking'] = not state.finished
+    elapsed = max((state.finished or time.time()) - state.started, 0.001)
+    progress['elapsed'] = elapsed
+    progress['rate'] = progress['seen'] / elapsed
+    progress['eta'] = None
+    if not state.finished and state.total is not None and progress['seen']:
+      remaining = max(state.total - progress['seen'], 0)
+      progress['eta'] = remaining / progress['rate']
+    return progress
+
+  def _Walk(self, roots, count, full):
+    batch = PhotoBatch(self.db)
+    state = _WalkState()
+    self.state = state
+    if count:
+      counter = threading.Thread(target=self._CountFiles, args=(roots, state))
+      counter.daemon = True
+      counter.start()
+    for full_path, meta in self._ReadAllMetadata(
+        self._ListChangedFiles(state, roots, full)):
+      state.counts['parsed'] += 1
+      if meta is None:
+        state.counts['failed'] += 1
+        continue
+
+      if full_path in state.indexed:
+        batch.Update(meta)
+      else:
+        batch.Store(meta)
+    for path in state.deleted:
+      batch.Delete(path)
+    for dirname in state.deleted_dirs:
+      for path in self.db.GetPhotosLastModifiedUnder(dirname):
+        batch.Delete(path)
+    batch.Flush()
+    self.db.WriteDirManifests(state.manifests, state.deleted_dirs)
     self.db.BuildCache()
+    state.finished = time.time()
+
+    counts = state.counts
+    elapsed = max(state.finished - state.started, 0.001)
+    logging.info(
+        'Walked %d files (%d parsed, %d failed) in %.1fs, %.1f files/s',
+        counts['seen'], counts['parsed'], counts['failed'], elapsed,
+        counts['seen'] / elapsed)
 
   def Sync(self):
-    self.db.BuildCache()
-    thread = threading.Timer(self._SYNC_TIMEOUT, target=self._Sync)
+    warmer = threading.Thread(target=self.db.BuildCache)
+    warmer.daemon = True
+    warmer.start()
+    thread = threading.Timer(self._SYNC_TIMEOUT, self._Sync)
+    thread.name = 'photofs-sync'
     thread.daemon = True
     thread.start() 
 
   def _Sync(self):
-    existing_photo_dict = self.db.GetAllPhotosLastModified()
-    existing_photos = existing_photo_dict.keys()
-    for path in existing_photos:
-      if not os.path.isfile(path):
-        self.db.DeletePhoto(path)
-    self.Walk(existing_photo_dict)
+    self.Walk()
 
   def ReadMetadata(self, path):
     meta = {}
@@ -101,10 +165,163 @@ class PhotoWalker(object):
     meta['month'] = meta['datetime'].strftime('%m')
     meta['day'] = meta['datetime'].strftime('%d')
     meta['datetime'] = meta['datetime'].strftime('%Y%m%d%H%M%S')
-    meta['last_modified'] = self._GetLastModified(path)
+    meta['last_modified'], meta['size'] = self._GetFileStat(os.stat(path))
     meta['path'] = path
 
     return meta
 
-  def _GetLastModified(self, path):
-    return datetime.fromtimestamp(os.path.getmtime(path)).strftime('%Y%m%d%H%M%S')
+  def _GetFileStat(self, st):
+    last_modified = datetime.fromtimestamp(st.st_mtime)
+    return last_modified.strftime('%Y%m%d%H%M%S'), st.st_size
+
+  def _ListChangedFiles(self, state, roots, full=False):
+    visited = set()
+    pending = list(roots)
+    while pending:
+      dirname = os.path.realpath(pending.pop())
+      if dirname in visited:  # symbolic links may form loops
+        continue
+      visited.add(dirname)
+      try:
+        dir_mtime = os.stat(dirname).st_mtime
+      except OSError:
+        continue
+
+      manifest = self.db.GetDirManifest(dirname)
+      if manifest and manifest[0] == dir_mtime and not full:
+        state.counts['seen'] += len(manifest[2])
+        pending.extend(os.path.join(dirname, d) for d in manifest[1])
+        continue
+
+      subdirs, filenames = self._ListDir(dirname)
+      state.manifests.append((dirname, dir_mtime, subdirs, filenames))
+      pending.extend(os.path.join(dirname, d) for d in subdirs)
+      full_paths = [
+          os.path.realpath(os.path.join(dirname, f)) for f in filenames]
+      if manifest:
+        _mtime, old_subdirs, old_filenames = manifest
+        state.deleted_dirs.extend(os.path.join(dirname, d)
+            for d in set(old_subdirs).difference(subdirs))
+        state.deleted.extend(os.path.join(dirname, f)
+            for f in set(old_filenames).difference(filenames))
+        existing_photo_dict = self.db.GetPhotosLastModified(full_paths)
+      else:  # not listed before, the index may still know some of its photos
+        existing_photo_dict = dict(
+            (p, file_stat) for p, file_stat
+            in self.db.GetPhotosLastModifiedUnder(dirname).iteritems()
+            if os.path.dirname(p) == dirname)
+        state.deleted.extend(
+            set(existing_photo_dict).difference(full_paths))
+
+      for full_path in full_paths:
+        state.counts['seen'] += 1
+        if full_path in existing_photo_dict:
+          state.indexed.add(full_path)
+          try:
+            file_stat = self._GetFileStat(os.stat(full_path))
+          except OSError:
+            continue
+          if file_stat == existing_photo_dict[full_path]:
+            continue
+        yield full_path
+
+  def _CountFiles(self, roots, state):
+    total = 0
+    visited = set()
+    pending = list(roots)
+    while pending:
+      dirname = os.path.realpath(pending.pop())
+      if dirname in visited:
+        continue
+      visited.add(dirname)
+      subdirs, filenames = self._ListDir(dirname)
+      pending.extend(os.path.join(dirname, d) for d in subdirs)
+      total += len(filenames)
+    state.total = total
+
+  def _ListDir(self, dirname):
+    subdirs = []
+    filenames = []
+    try:
+      names = os.listdir(dirname)
+    except OSError:
+      return subdirs, filenames
+    for name in names:
+      if name.startswith(TMP_PREFIX):
+        continue
+      if os.path.isdir(os.path.join(dirname, name)):
+        subdirs.append(name)
+      else:
+        filenames.append(name)
+    return subdirs, filenames
+
+  def _ReadAllMetadata(self, paths):
+    '''Yields (path, meta) pairs, meta is None if the file can't be read.
+
+    With more than one worker GExiv2 runs in a pool of processes while this
+    (single) thread keeps consuming the results and writing them to the db.
+    The workers are forked while FUSE, watcher and timer threads keep
+    running, see _InitWorker. The pool is only forked once there are
+    _POOL_MIN_PATHS to parse, walks finding a few changed files and the
+    polls of the watcher parse them in this thread.
+    '''
+    paths = iter(paths)
+    first = []
+    if self.workers > 1:
+      first = list(itertools.islice(paths, self._POOL_MIN_PATHS))
+    if len(first) < self._POOL_MIN_PATHS:
+      for path in itertools.chain(first, paths):
+        yield _ReadMetadataSafe(self, path)
+      return
+
+    pool = multiprocessing.Pool(self.workers, _InitWorker)
+    try:
+      for result in pool.imap_unordered(
+          _ReadMetadataWorker, itertools.chain(first, paths),
+          self._WORKER_CHUNK_SIZE):
+        yield result
+    finally:
+      pool.terminate()
+      pool.join()
+
+
+class _WalkState(object):
+  def __init__(self):
+    self.started = time.time()
+    self.finished = None
+    self.total = None  # files under the roots, if they were counted
+    self.counts = {'seen': 0, 'parsed': 0, 'failed': 0}
+    self.indexed = set()  # changed files that are already in the index
+    self.deleted = []
+    self.deleted_dirs = []
+    self.manifests = []  # (dirname, mtime, subdirs, filenames)
+
+
+def _ReadMetadataSafe(walker, path):
+  try:
+    return path, walker.ReadMetadata(path)
+  except Exception, e:
+    logging.error('Failed adding %s', path)
+    logging.exception(e)
+    return path, None
+
+
+def _InitWorker():
+  '''Replaces the logging locks a forked worker inherited.
+
+  fork() copies only the calling thread. A lock another thread of the
+  parent held at that moment, in the middle of logging for instance, stays
+  locked in the worker as no thread is left to release it, and the first
+  message the worker logs would hang it. Locks of C libraries, GExiv2 and
+  GLib included, can't be replaced like this: a file parsed by the watcher
+  while the pool starts may still leave a worker stuck.
+  '''
+  logging._lock = threading.RLock()
+  for ref in logging._handlerList:
+    handler = ref()
+    if handler:
+      handler.createLock()
+
+
+def _ReadMetadataWorker(path):
+  return _ReadMetadataSafe(PhotoWalker(None, None), path)
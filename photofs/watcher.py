@@ -4,62 +4,267 @@
 
 __author__ = 'drseergio@gmail.com (Sergey Pisarenko)'
 
+from collections import OrderedDict
+import logging
 import os
+import threading
+import time
 
 from pyinotify import WatchManager, ThreadedNotifier, EventsCodes, ProcessEvent
 
+from photofs.buffers import TMP_PREFIX
+
 
 class PhotoWatcher(ProcessEvent):
   MASK = (EventsCodes.ALL_FLAGS['IN_DELETE'] |
           EventsCodes.ALL_FLAGS['IN_CLOSE_WRITE'] |
           EventsCodes.ALL_FLAGS['IN_MOVED_FROM'] |
-          EventsCodes.ALL_FLAGS['IN_MOVED_TO'])
+          EventsCodes.ALL_FLAGS['IN_MOVED_TO'] |
+          EventsCodes.ALL_FLAGS['IN_CREATE'])
+  _MAX_USER_WATCHES_PATH = '/proc/sys/fs/inotify/max_user_watches'
+  _POLL_INTERVAL_SEC = 60 * 5  # re-scan subtrees that couldn't be watched
+  _DEBOUNCE_SEC = 1  # wait for a file to settle before reading it
+  _BATCH_SIZE = 500  # most events written in a single transaction
+  _WRITE = 'write'
+  _DELETE = 'delete'
 
-  def __init__(self, db, walker, root):
+  def __init__(self, db, walker, root, file_cache=None, max_watches=0):
     self.root = root
     self.db = db
     self.walker = walker
+    self.file_cache = file_cache
+    self.max_watches = max_watches or self._GetDefaultMaxWatches()
     self.wm = WatchManager()
-    self.wdds = []
+    self.watch_lock = threading.Lock()
+    self.watched = set()  # real paths of directories with a watch
+    self.polled = set()  # roots of subtrees that are scanned periodically
+    self.polling = False  # a poll is scheduled
+    self.queue = OrderedDict()  # path -> (action, time of last event)
+    self.queue_cond = threading.Condition()
+    self.stopped = False
 
   def Watch(self):
+    worker = threading.Thread(
+        target=self._ProcessQueue, name='photofs-watcher')
+    worker.daemon = True
+    worker.start()
     self.notifier = ThreadedNotifier(self.wm, self)
     self.notifier.start()
-    self.wdds.append(self.wm.add_watch(self.root, self.MASK, rec=True))
-    # add soft link sub-folders
-    for dirname, dirnames, _filenames in os.walk(self.root, followlinks=True):
-      for d in dirnames:
-        path = os.path.join(dirname, d)
-        if os.path.islink(path):
-          self.wdds.append(
-              self.wm.add_watch(os.path.realpath(path), self.MASK, rec=True))
+    # the file system is usable while the watches are being added
+    registrar = threading.Thread(
+        target=self._WatchTree, name='photofs-watch-setup', args=(self.root,))
+    registrar.daemon = True
+    registrar.start()
 
   def Stop(self):
     self.notifier.stop()
+    self.queue_cond.acquire()
+    self.stopped = True
+    self.queue_cond.notify()
+    self.queue_cond.release()
+
+  def GetStats(self):
+    self.queue_cond.acquire()
+    stats = {'queue_depth': len(self.queue)}
+    self.queue_cond.release()
+    self.watch_lock.acquire()
+    stats['watches'] = len(self.watched)
+    stats['polled_dirs'] = len(self.polled)
+    self.watch_lock.release()
+    return stats
+
+  def process_IN_CREATE(self, event):
+    # files are picked up by CLOSE_WRITE, only new directories need a watch
+    if event.dir:
+      self._WatchNewDir(os.path.join(event.path, event.name))
 
   def process_IN_DELETE(self, event):
-    self.db.DeletePhoto(os.path.join(event.path, event.name))
+    full_path = os.path.join(event.path, event.name)
+    if event.dir:
+      self._UnwatchTree(full_path)
+      # a directory moved away doesn't report its files
+      for path in self.db.GetPhotosLastModifiedUnder(full_path):
+        self._Enqueue(path, self._DELETE)
+    else:
+      self._Enqueue(full_path, self._DELETE)
 
   def process_IN_MOVED_FROM(self, event):
     self.process_IN_DELETE(event)
 
   def process_IN_MOVED_TO(self, event):
     full_path = os.path.join(event.path, event.name)
-    try:
-      meta = self.walker.ReadMetadata(full_path)
-    except Exception:
+    if event.dir:
+      self._WatchNewDir(full_path)
+    else:
+      self._Enqueue(full_path, self._WRITE)
+
+  def process_IN_CLOSE_WRITE(self, event):
+    self._Enqueue(os.path.join(event.path, event.name), self._WRITE)
+
+  def _WatchNewDir(self, dirname):
+    # files may have landed in it before its watch was added
+    for path in self._WatchTree(dirname):
+      self._Enqueue(path, self._WRITE)
+
+  def _WatchTree(self, top):
+    '''Adds a watch to every directory under top and returns their files.
+
+    Every directory takes one of the user's inotify watches. Once the
+    budget is used up the remaining subtrees are scanned periodically by
+    the walker instead.
+    '''
+    files = []
+    pending = [top]
+    while pending:
+      dirname = os.path.realpath(pending.pop(0))
+      self.watch_lock.acquire()
+      try:
+        # symbolic links may form loops
+        if dirname in self.watched or dirname in self.polled:
+          continue
+        if len(self.watched) >= self.max_watches or not self._AddWatch(dirname):
+          self._PollSubtrees([dirname] + pending)
+          break
+        self.watched.add(dirname)
+      finally:
+        self.watch_lock.release()
+
+      try:
+        names = os.listdir(dirname)
+      except OSError:
+        continue
+      for name in names:
+        path = os.path.join(dirname, name)
+        if os.path.isdir(path):
+          pending.append(path)
+        else:
+          files.append(path)
+    if top == self.root:
+      logging.info('Watching %d directories', len(self.watched))
+    return files
+
+  def _UnwatchTree(self, top):
+    self.watch_lock.acquire()
+    dirnames = [d for d in self.watched
+                if d == top or d.startswith(top + '/')]
+    self.watched.difference_update(dirnames)
+    self.polled.difference_update(
+        [d for d in self.polled if d == top or d.startswith(top + '/')])
+    self.watch_lock.release()
+    for dirname in dirnames:
+      wd = self.wm.get_wd(dirname)
+      if wd is not None:
+        self.wm.rm_watch(wd, quiet=True)
+
+  def _AddWatch(self, dirname):
+    wdd = self.wm.add_watch(dirname, self.MASK, quiet=True)
+    if wdd.get(dirname, -1) < 0:  # most likely ENOSPC, out of user watches
+      logging.warning('Failed to watch %s', dirname)
+      return False
+    return True
+
+  def _PollSubtrees(self, dirnames):
+    '''Scans dirnames periodically, the caller holds watch_lock.'''
+    if not self.polling:
+      self.polling = True
+      self._SchedulePoll()
+    self.polled.update(os.path.realpath(d) for d in dirnames)
+    logging.warning(
+        'Out of inotify watches, %d directories are scanned every %d seconds',
+        len(self.polled), self._POLL_INTERVAL_SEC)
+
+  def _Poll(self):
+    self.watch_lock.acquire()
+    dirnames = list(self.polled)
+    if not dirnames:  # all of them were removed, Walk([]) would walk the root
+      self.polling = False
+    self.watch_lock.release()
+    if not dirnames:
       return
+    try:
+      # polled files may be rewritten in place, so manifests can't be trusted
+      self.walker.Walk(dirnames, full=True)
+    except Exception, e:
+      logging.error('Failed scanning unwatched directories')
+      logging.exception(e)
+    self._SchedulePoll()
 
-    self.db.StorePhoto(full_path, meta)
+  def _SchedulePoll(self):
+    t = threading.Timer(self._POLL_INTERVAL_SEC, self._Poll)
+    t.name = 'photofs-poll'
+    t.daemon = True
+    t.start()
 
-  def process_IN_CLOSE_WRITE(self, event):
-    full_path = os.path.join(event.path, event.name)
+  def _GetDefaultMaxWatches(self):
+    # leave half of the watches to other programs of the user
     try:
-      meta = self.walker.ReadMetadata(full_path)
-    except Exception:
+      return int(open(self._MAX_USER_WATCHES_PATH).read()) / 2
+    except (IOError, ValueError):
+      return 8192
+
+  def _Enqueue(self, full_path, action):
+    if os.path.basename(full_path).startswith(TMP_PREFIX):
       return
+    # the file changed even if its meta-data (and so the index) did not
+    if self.file_cache:
+      self.file_cache.Invalidate(full_path)
+    self.queue_cond.acquire()
+    # the latest event for a path wins and restarts its quiet period
+    self.queue.pop(full_path, None)
+    self.queue[full_path] = (action, time.time())
+    self.queue_cond.notify()
+    self.queue_cond.release()
 
-    if self.db.HasPhoto(full_path):
-      self.db.UpdatePhoto(full_path, meta)
-    else:
-      self.db.StorePhoto(full_path, meta)
+  def _ProcessQueue(self):
+    while True:
+      batch = self._TakeBatch()
+      if batch is None:
+        return
+      try:
+        self._ProcessBatch(batch)
+      except Exception, e:
+        logging.error('Failed processing %d file events', len(batch))
+        logging.exception(e)
+
+  def _TakeBatch(self):
+    '''Waits for paths that had no events for _DEBOUNCE_SEC and takes them.'''
+    self.queue_cond.acquire()
+    try:
+      while not self.stopped:
+        now = time.time()
+        batch = []
+        # queue is ordered by the time of the last event
+        for full_path, (action, event_time) in self.queue.iteritems():
+          if (now - event_time < self._DEBOUNCE_SEC or
+              len(batch) >= self._BATCH_SIZE):
+            break
+          batch.append((full_path, action))
+        if batch:
+          for full_path, _action in batch:
+            del self.queue[full_path]
+          return batch
+        if self.queue:
+          oldest = next(self.queue.itervalues())[1]
+          self.queue_cond.wait(self._DEBOUNCE_SEC - (now - oldest))
+        else:
+          self.queue_cond.wait()
+      return None
+    finally:
+      self.queue_cond.release()
+
+  def _ProcessBatch(self, batch):
+    deleted = [p for p, action in batch if action == self._DELETE]
+    written = [p for p, action in batch if action == self._WRITE]
+    existing = self.db.GetPhotosLastModified(written)
+    stored = []
+    updated = []
+    for full_path in written:
+      try:
+        meta = self.walker.ReadMetadata(full_path)
+      except Exception:
+        continue
+      if full_path in existing:
+        updated.append(meta)
+      else:
+        stored.append(meta)
+    self.db.WriteBatch(stored, updated, deleted)
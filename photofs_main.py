@@ -5,16 +5,29 @@
 __author__ = 'drseergio@gmail.com (Sergey Pisarenko)'
 
 import errno
+import itertools
+import json
 import logging
 import os
 import sys
 import threading
+import time
+import types
 
 import fuse
 from fuse import Fuse
 
+from photofs.buffers import TmpBufferTable
+from photofs.cache import PhotoFileCache
+from photofs.facets import FacetIndex
+from photofs.handles import FileHandleTable
+from photofs.profiler import SamplingProfiler
+from photofs.stats import OpStats
 from photofs.storage import PhotoDb
-from photofs.views import FsStat, GetViews
+from photofs.tags import TagIndex
+from photofs.thumbs import ThumbnailCache
+from photofs.tree import PhotoTree
+from photofs.views import FsStat, GetViews, NAMINGS, StatusFile
 from photofs.walker import PhotoWalker
 from photofs.watcher import PhotoWatcher
 
@@ -22,35 +35,112 @@ fuse.fuse_python_api = (0, 2)
 
 
 class PhotoFS(Fuse):
+  _FILE_CACHE_MB = 16
+  _MAX_OPEN_FILES = 256
+  _THUMB_CACHE_MB = 256
+  _PROGRESS_FILE = '.photofs-progress'
+  _STATS_FILE = '.photofs-stats'
+  _PROFILE_DIR_ENV = 'PHOTOFS_PROFILE_DIR'
+  _ROOT_INO = 1
+  # the kernel may answer lookups and getattr for this long without asking,
+  # changes made by the watcher show up after at most as long
+  _KERNEL_CACHE_OPTIONS = {'entry_timeout': '5', 'attr_timeout': '5'}
+
   def main(self, *a, **kw):
     if not self.fuse_args.getmod('showhelp'):
       self._validate_args()
-      self.db = PhotoDb(self.root)
-      self.views = GetViews(self.db)
-
-      if self.db.TryLock():
-        logging.info('Acquired database lock, will write/update it')
-      else:
-        logging.error(('Failed to acquire database lock, '
-                       'another instance is already running'))
-        sys.exit(0)
+      self.Setup()
+      # st_ino is stable, and file contents are cached until their mtime or
+      # size changes
+      self.fuse_args.add('use_ino')
+      self.fuse_args.add('auto_cache')
+      if self.read_only:
+        self.fuse_args.add('ro')
+      for name, value in self._KERNEL_CACHE_OPTIONS.iteritems():
+        if name not in self.fuse_args.optdict:
+          self.fuse_args.add(name, value)
 
     return Fuse.main(self, *a, **kw)
 
+  def Setup(self):
+    '''Opens the index and builds the views, nothing gets mounted.'''
+    self.db = PhotoDb(self.root, self.index_dir)
+
+    if self.read_only:
+      if not self.db.OpenReadOnly():
+        logging.error(('No up to date index to open read-only, '
+                       'mount without "read_only" first'))
+        sys.exit(0)
+      logging.info('Opened database read-only')
+    elif self.db.TryLock():
+      logging.info('Acquired database lock, will write/update it')
+    else:
+      logging.error(('Failed to acquire database lock, '
+                     'another instance is already running, '
+                     'mount with "read_only" to share its index'))
+      sys.exit(0)
+
+    photo_db = self.db
+    if self.memory_index:
+      photo_db = FacetIndex(PhotoTree(photo_db))
+    self.tag_index = TagIndex(photo_db)
+    photo_db = self.tag_index
+    self.file_cache = PhotoFileCache(photo_db, self.file_cache_mb << 20)
+    self.handles = FileHandleTable(self.max_open_files)
+    self.tmp_buffers = TmpBufferTable()
+    thumbs_dir = '%s.thumbs' % self.db.db_path
+    if self.read_only:  # the previews of the writing instance aren't ours
+      thumbs_dir = os.path.join(
+          PhotoDb._CONF_DIR, '%s.ro.thumbs' % os.path.basename(self.db.db_path))
+    self.thumbs = ThumbnailCache(
+        photo_db, self.file_cache, thumbs_dir, self.thumb_cache_mb << 20)
+    self.views = GetViews(photo_db, self.file_cache, self.handles,
+                          self.tmp_buffers, self.thumbs, self.naming)
+    self.walker = None  # read-only instances leave indexing to the writer
+    if not self.read_only:
+      self.walker = PhotoWalker(self.root, self.db, self.index_workers)
+    self.watcher = None
+    self.op_stats = OpStats()
+    self.profiler = None
+    if self.profile_dir:
+      self.profiler = SamplingProfiler(self.profile_dir)
+    self.status_files = {
+        self._PROGRESS_FILE: StatusFile(
+            self._PROGRESS_FILE, self._RenderProgress),
+        self._STATS_FILE: StatusFile(self._STATS_FILE, self._RenderStats)}
+    # sqlite connections must not cross the daemonizing fork, the pool
+    # opens new ones once the file system gets used
+    self.db.Close()
+
   def fsinit(self):
-    self.walker = PhotoWalker(self.root, self.db)
-    self.watcher = PhotoWatcher(self.db, self.walker, self.root)
+    # threads don't survive daemonizing, they are started here
+    if self.profiler:
+      self.profiler.Start()
+    self.tmp_buffers.Start()
+    self.tag_index.Start()
+    if self.read_only:
+      self.db.FollowChanges()
+      return
+    self.watcher = PhotoWatcher(
+        self.db, self.walker, self.root, self.file_cache, self.max_watches)
     if self.db.IsEmptyDb():
-      self.walker.Walk()
+      # photos show up in the views as their batches get written
+      indexer = threading.Thread(target=self.walker.Walk,
+                                 name='photofs-indexer', kwargs={'count': True})
+      indexer.daemon = True
+      indexer.start()
     else:
       self.walker.Sync()
     self.watcher.Watch()
 
   def fsdestroy(self):
+    self.tag_index.Save()
+    if self.profiler:
+      self.profiler.Dump()
     sys.exit(0)
 
   def RouteView(func):
-    def inner(*args, **kwargs):
+    def route(*args, **kwargs):
       path_split = args[1].split('/')
 
       if not path_split[1]:
@@ -60,6 +150,14 @@ class PhotoFS(Fuse):
       view = path_split[1]
       self = args[0]
 
+      if view in self.status_files:
+        if len(path_split) > 2:
+          return -errno.ENOTDIR
+        handler = getattr(self.status_files[view], func.__name__, None)
+        if not handler:
+          return -errno.EACCES
+        return handler(*args[2:], **kwargs)
+
       if view not in self.views.keys():
         return -errno.ENOENT
 
@@ -67,40 +165,72 @@ class PhotoFS(Fuse):
       kwargs['path_split'] = path_split
 
       return func(*args, **kwargs)
+
+    def inner(*args, **kwargs):
+      self = args[0]
+      view = args[1].split('/')[1]
+      if not view:
+        view = '/'
+      elif view not in self.views and view not in self.status_files:
+        view = '?'  # don't keep stats for every bad path
+      started = time.time()
+      if self.profiler:
+        self.profiler.EnterOp(func.__name__)
+      try:
+        result = route(*args, **kwargs)
+      except Exception:
+        self.op_stats.Record(func.__name__, view, time.time() - started, True)
+        raise
+      finally:
+        if self.profiler:
+          self.profiler.LeaveOp()
+      if isinstance(result, types.GeneratorType):  # readdir does its work late
+        if self.profiler:
+          result = self.profiler.ProfileIterator(result, func.__name__)
+        return self.op_stats.TimeIterator(
+            result, func.__name__, view, started)
+      self.op_stats.Record(func.__name__, view, time.time() - started,
+                           isinstance(result, int) and result < 0)
+      return result
     return inner
 
   @RouteView
   def getattr(self, path, is_root=False, view=None, path_split=None):
-    if is_root or len(path_split) == 2:
-      return FsStat()
+    if is_root:
+      return FsStat(self._ROOT_INO, self.db.GetLastChange())
+    if len(path_split) == 2:
+      return view.GetDirStat([])
     return view.getattr(path_split[2:])
  
   @RouteView
   def readdir(self, path, offset, is_root=False, view=None, path_split=None):
-    entries = ['.', '..']
+    # offset is that of the last entry the kernel got, entries are numbered
+    # from 1 with '.' and '..' first
     if is_root:
-      entries.extend(self.views.keys())
+      entries = sorted(self.views.keys()) + sorted(self.status_files.keys())
+      entries = entries[max(offset - 2, 0):]
     else:
-      entries.extend(view.readdir(path_split[2:], offset))
+      entries = view.readdir(path_split[2:], max(offset - 2, 0))
 
-    for e in entries:
-      yield fuse.Direntry(e)
+    entries = itertools.chain(['.', '..'][offset:], entries)
+    for i, e in enumerate(entries, offset + 1):
+      yield fuse.Direntry(e, offset=i)
  
   @RouteView
   def open(self, path, flags, view=None, path_split=None):
     return view.open(path_split[2:], flags)
  
   @RouteView
-  def read(self, path, length, offset, view=None, path_split=None):
-    return view.read(path_split[2:], length, offset)
+  def read(self, path, length, offset, fh=None, view=None, path_split=None):
+    return view.read(path_split[2:], length, offset, fh)
 
   @RouteView
-  def write(self, path, buf, offset, view=None, path_split=None):
-    return view.write(path_split[2:], buf, offset)
+  def write(self, path, buf, offset, fh=None, view=None, path_split=None):
+    return view.write(path_split[2:], buf, offset, fh)
 
   @RouteView
-  def release(self, path, flags, view=None, path_split=None):
-    return view.release(path_split[2:], flags)
+  def release(self, path, flags, fh=None, view=None, path_split=None):
+    return view.release(path_split[2:], flags, fh)
 
   @RouteView
   def unlink(self, path, view=None, path_split=None):
@@ -114,6 +244,42 @@ class PhotoFS(Fuse):
   def truncate(self, path, length, view=None, path_split=None):
     return view.truncate(path_split[2:], length)
 
+  def _RenderProgress(self):
+    if not self.walker:
+      return 'state: read-only\n'
+    progress = self.walker.GetProgress()
+    if 'seen' not in progress:  # nothing was walked yet
+      return 'state: idle\n'
+    lines = [
+        'state: %s' % ('indexing' if progress['walking'] else 'done'),
+        'seen: %d' % progress['seen'],
+        'indexed: %d' % progress['indexed'],
+        'failed: %d' % progress['failed'],
+        'total: %s' % (
+            'unknown' if progress['total'] is None else progress['total']),
+        'rate: %.1f files/s' % progress['rate'],
+        'elapsed: %s' % _FormatDuration(progress['elapsed'])]
+    if progress['eta'] is not None:
+      lines.append('eta: %s' % _FormatDuration(progress['eta']))
+    return '\n'.join(lines) + '\n'
+
+  def _RenderStats(self):
+    stats = {
+        'ops': self.op_stats.GetStats(),
+        'histogram_buckets_ms': OpStats.BUCKETS_MS,
+        'db_cache': self.db.GetCacheStats(),
+        'file_cache': self.file_cache.GetStats(),
+        'handles': self.handles.GetStats(),
+        'thumbs': self.thumbs.GetStats()}
+    if self.walker:
+      stats['indexer'] = self.walker.GetProgress()
+    if self.watcher:
+      stats['watcher'] = self.watcher.GetStats()
+    for cache in ('db_cache', 'file_cache'):
+      lookups = stats[cache]['hits'] + stats[cache]['misses']
+      stats[cache]['hit_rate'] = stats[cache]['hits'] / float(lookups or 1)
+    return json.dumps(stats, indent=2, sort_keys=True) + '\n'
+
   def _validate_args(self):
     if not self.cmdline[0].root:
       print '"root" parameter must be specified'
@@ -125,11 +291,79 @@ class PhotoFS(Fuse):
 
     self.root = self.cmdline[0].root
 
+    try:
+      self.index_workers = int(self.cmdline[0].index_workers or 1)
+      self.file_cache_mb = int(
+          self.cmdline[0].file_cache_mb or self._FILE_CACHE_MB)
+      self.max_open_files = int(
+          self.cmdline[0].max_open_files or self._MAX_OPEN_FILES)
+      self.max_watches = int(self.cmdline[0].max_watches or 0)
+      self.thumb_cache_mb = int(
+          self.cmdline[0].thumb_cache_mb or self._THUMB_CACHE_MB)
+    except ValueError:
+      print ('"index_workers", "file_cache_mb", "max_open_files", '
+             '"max_watches" and "thumb_cache_mb" must be numbers')
+      sys.exit(0)
+
+    self.memory_index = bool(self.cmdline[0].memory_index)
+    self.read_only = bool(self.cmdline[0].read_only)
+    self.index_dir = self.cmdline[0].index_dir
+    self.naming = self.cmdline[0].naming or NAMINGS[0]
+    if self.naming not in NAMINGS:
+      print '"naming" must be one of %s' % ', '.join(NAMINGS)
+      sys.exit(0)
+    self.profile_dir = (
+        self.cmdline[0].profile_dir or os.environ.get(self._PROFILE_DIR_ENV))
+
+
+def _FormatDuration(seconds):
+  minutes, seconds = divmod(int(seconds), 60)
+  hours, minutes = divmod(minutes, 60)
+  return '%d:%02d:%02d' % (hours, minutes, seconds)
+
 
 def main():
   photo_fs = PhotoFS()
   photo_fs.parser.add_option(mountopt='root', metavar='PATH',
                        help='Path to folder containing your photos.')
+  photo_fs.parser.add_option(mountopt='index_workers', metavar='N',
+                       help=('Number of processes reading photo meta-data '
+                             'while indexing [default: 1].'))
+  photo_fs.parser.add_option(mountopt='memory_index', action='store_true',
+                       help=('Keep the date, albums and camera views in '
+                             'memory to answer directory listings without '
+                             'queries.'))
+  photo_fs.parser.add_option(mountopt='read_only', action='store_true',
+                       help=('Share the index of the instance already '
+                             'running on root instead of writing it, the '
+                             'views follow its changes.'))
+  photo_fs.parser.add_option(mountopt='index_dir', metavar='PATH',
+                       help=('Folder keeping the index [default: '
+                             '~/.photofs].'))
+  photo_fs.parser.add_option(mountopt='naming', metavar='MODE',
+                       help=('How photos are named, "index" numbers them by '
+                             'their position in the folder, "date" names '
+                             'them after when they were taken so names '
+                             'never change [default: index].'))
+  photo_fs.parser.add_option(mountopt='file_cache_mb', metavar='MB',
+                       help=('Memory used to cache paths and attributes of '
+                             'photo files [default: %d].' %
+                             PhotoFS._FILE_CACHE_MB))
+  photo_fs.parser.add_option(mountopt='max_open_files', metavar='N',
+                       help=('Number of photo files kept open for reading '
+                             '[default: %d].' % PhotoFS._MAX_OPEN_FILES))
+  photo_fs.parser.add_option(mountopt='thumb_cache_mb', metavar='MB',
+                       help=('Disk space used to cache previews for the '
+                             '"thumbs" view [default: %d].' %
+                             PhotoFS._THUMB_CACHE_MB))
+  photo_fs.parser.add_option(mountopt='max_watches', metavar='N',
+                       help=('Number of directories watched with inotify, '
+                             'the rest is scanned every few minutes '
+                             '[default: half of fs.inotify.max_user_watches].'))
+  photo_fs.parser.add_option(mountopt='profile_dir', metavar='PATH',
+                       help=('Sample what photofs is busy with and write '
+                             'the stacks to this folder every minute, also '
+                             'set by $%s.' % PhotoFS._PROFILE_DIR_ENV))
   photo_fs.parse(errex=1)
   photo_fs.main()
 
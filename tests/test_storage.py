@@ -0,0 +1,326 @@
+# -*- encoding: utf-8 -*-
+
+'''test_storage.py: checks query plans and migrations of the photofs index.'''
+
+__author__ = 'drseergio@gmail.com (Sergey Pisarenko)'
+
+from contextlib import contextmanager
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+from photofs.storage import PhotoDb
+
+
+def _Meta(n, year='2010', month='01', day='01', label='red', tags=('sea',)):
+  return {
+      'path': '/lib/%d.jpg' % n, 'datetime': '%s%s%s1200%02d' % (
+          year, month, day, n % 60),
+      'last_modified': '20130101000000', 'year': year, 'month': month,
+      'day': day, 'f': '2.8', 'iso': '100', 'make': 'Canon', 'camera': '5D',
+      'focal_length': '50', 'lens_model': None, 'lens_spec': '50',
+      'label': label, 'size': n, 'tags': list(tags)}
+
+
+class _RecordingCursor(object):
+  def __init__(self, cursor, statements):
+    self.cursor = cursor
+    self.statements = statements
+
+  def execute(self, sql, params=()):
+    self.statements.append((sql, params))
+    return self.cursor.execute(sql, params)
+
+  def __getattr__(self, name):
+    return getattr(self.cursor, name)
+
+
+class _RecordingConnection(object):
+  '''Records the statements run through cursors of a connection.'''
+
+  def __init__(self, conn):
+    self.conn = conn
+    self.statements = []
+
+  def cursor(self):
+    return _RecordingCursor(self.conn.cursor(), self.statements)
+
+  def __getattr__(self, name):
+    return getattr(self.conn, name)
+
+
+class IndexTestCase(unittest.TestCase):
+  def setUp(self):
+    self.index_dir = tempfile.mkdtemp()
+    self.dbs = []
+
+  def tearDown(self):
+    for db in self.dbs:
+      self.CloseDb(db)
+    shutil.rmtree(self.index_dir)
+
+  def OpenDb(self):
+    db = PhotoDb('/lib', self.index_dir)
+    self.dbs.append(db)
+    self.assertTrue(db.TryLock())
+    return db
+
+  def CloseDb(self, db):
+    db.Close()
+    db.lock_fd.close()
+
+
+class QueryPlanTest(IndexTestCase):
+  '''Listings of the views read a single covering index in order, lookups
+  search an index.'''
+
+  def setUp(self):
+    IndexTestCase.setUp(self)
+    self.db = self.OpenDb()
+    self.db.WriteBatch(
+        [_Meta(i, month='%02d' % (i % 12 + 1), label=('red', 'blue')[i % 2],
+               tags=('sea', 'sky')[:i % 3]) for i in xrange(200)], [], [])
+    # photofs never runs ANALYZE, the plans must not need statistics
+    self.conn = sqlite3.connect(self.db.db_path)
+
+  def tearDown(self):
+    self.conn.close()
+    IndexTestCase.tearDown(self)
+
+  def GetPlans(self, method, *args):
+    '''Returns the plan steps of every query method runs.'''
+    recorder = _RecordingConnection(self.conn)
+    @contextmanager
+    def Lend():
+      yield recorder
+    self.db._Connection = Lend
+    try:
+      getattr(self.db, method)(*args)
+    finally:
+      del self.db._Connection
+    self.assertTrue(recorder.statements, '%s ran no query' % method)
+    return [[row[3] for row in
+             self.conn.execute('EXPLAIN QUERY PLAN ' + sql, params)]
+            for sql, params in recorder.statements]
+
+  def assertCovered(self, method, *args):
+    for plan in self.GetPlans(method, *args):
+      for step in plan:
+        if step.startswith(('SEARCH', 'SCAN')):
+          self.assertIn('USING COVERING INDEX', step, '%s: %s' % (
+              method, plan))
+        self.assertNotIn('TEMP B-TREE', step, '%s: %s' % (method, plan))
+
+  def assertSearched(self, method, args, temp_btrees=()):
+    '''Checks method searches indexes, sorting only for temp_btrees.
+
+    temp_btrees are the clauses such as 'GROUP BY' allowed to sort.
+    '''
+    for plan in self.GetPlans(method, *args):
+      for step in plan:
+        message = '%s: %s' % (method, plan)
+        self.assertFalse(step.startswith('SCAN'), message)
+        if step.startswith('SEARCH'):
+          self.assertTrue(
+              ' USING INDEX ' in step or ' USING COVERING INDEX ' in step or
+              ' USING INTEGER PRIMARY KEY ' in step, message)
+        if 'TEMP B-TREE' in step:
+          self.assertIn(step.split(' FOR ')[-1], temp_btrees, message)
+
+  def testDateListings(self):
+    self.assertCovered('GetYears')
+    self.assertCovered('GetMonths', '2010')
+    self.assertCovered('GetDays', '2010', '01')
+    self.assertCovered('ListPhotosByYear', '2010')
+    self.assertCovered('ListPhotosByMonth', '2010', '01')
+    self.assertCovered('ListPhotos', '2010', '01', '01')
+
+  def testLabelListings(self):
+    self.assertCovered('GetLabels')
+    self.assertCovered('ListPhotosByLabel', 'red')
+    self.assertCovered('ListSelectsByLabel', 'sea', 'red')
+    self.assertCovered('ListSelectsByLabel', 'sky', 'blue')
+    self.assertCovered('ListSelectsByLabel', 'selects', 'red')
+    self.assertCovered('ListSelectsByLabel', 'sea', 'green')
+
+  def testTagListings(self):
+    self.assertCovered('GetTags')
+    # intersections group the photos of the tags, then sort what is left;
+    # the views ask TagIndex, which answers them from memory
+    for tags in (['sea'], ['sea', 'sky']):
+      self.assertSearched('ListPhotosByTags', [tags], ('GROUP BY', 'ORDER BY'))
+      self.assertSearched('GetRelatedTags', [tags], ('GROUP BY', 'DISTINCT'))
+
+  def testConfListings(self):
+    for conf in PhotoDb._CONF_COLUMNS:
+      self.assertCovered('GetConfValues', conf)
+      self.assertCovered('ListPhotosByConf', [conf], ['100'])
+
+  def testPhotoLookups(self):
+    self.assertSearched('GetRealPhotoPath', [5])
+    self.assertSearched('GetPhotoDate', [5])
+    self.assertCovered('HasPhoto', '/lib/5.jpg')
+    self.assertSearched(
+        'GetPhotosLastModified', [['/lib/5.jpg', '/lib/6.jpg']])
+    self.assertSearched('GetPhotosLastModifiedUnder', ['/lib'])
+
+
+class _Listener(object):
+  def __init__(self):
+    self.calls = []
+
+  def OnPhotosChanged(self, photos, removed):
+    self.calls.append((photos, removed))
+
+  def OnIndexChanged(self):
+    self.calls.append(None)
+
+
+class WriteBatchTest(IndexTestCase):
+  def testStoresUpdatedPhotoDeletedMeanwhile(self):
+    db = self.OpenDb()
+    db.WriteBatch([_Meta(1), _Meta(2)], [], [])
+    db.WriteBatch([], [], ['/lib/1.jpg'])
+    db.WriteBatch([], [_Meta(2, label='blue'), _Meta(1, label='blue')], [])
+    self.assertTrue(db.HasPhoto('/lib/1.jpg'))
+    self.assertEqual(
+        ['/lib/1.jpg', '/lib/2.jpg'],
+        sorted(db.GetRealPhotoPath(i) for i in db.ListPhotosByLabel('blue')))
+    self.assertEqual([], db.ListPhotosByLabel('red'))
+
+
+class QueryCacheTest(IndexTestCase):
+  def testSkipsResultsQueriedBeforeAWrite(self):
+    db = self.OpenDb()
+    db.WriteBatch([_Meta(1)], [], [])
+    cached, generation = db._GetCache('years')
+    self.assertEqual(None, cached)
+    # a reader that queried before this write stores its result after it
+    db.WriteBatch([_Meta(2, year='2011')], [], [])
+    db._SetCache('years', set(['2010']), generation)
+    self.assertEqual(set(['2010', '2011']), db.GetYears())
+    self.assertEqual(set(['2010', '2011']), db._GetCache('years')[0])
+
+
+class ChangesLogTest(IndexTestCase):
+  '''Read-only instances apply the writes of the locking instance.'''
+
+  def setUp(self):
+    IndexTestCase.setUp(self)
+    self.db = self.OpenDb()
+    self.db.WriteBatch([_Meta(1), _Meta(2)], [], [])
+    self.follower = PhotoDb('/lib', self.index_dir)
+    self.addCleanup(self.follower.Close)
+    self.assertTrue(self.follower.OpenReadOnly())
+    self.follower.FollowChanges = lambda: None  # polled by the tests
+    self.listener = _Listener()
+    self.follower.AddListener(self.listener)
+
+  def testAppliesLoggedWrites(self):
+    self.follower._PollChanges()
+    self.assertEqual([], self.listener.calls)
+
+    self.db.WriteBatch([_Meta(3, day='02', tags=('sky',))], [], [])
+    self.db.WriteBatch([], [_Meta(1, label='blue')], ['/lib/2.jpg'])
+    self.follower._PollChanges()
+    [(photos, removed)] = self.listener.calls
+    photos = dict((p['id'], p) for p in photos)
+    self.assertEqual([1, 3], sorted(photos))
+    self.assertEqual('blue', photos[1]['label'])
+    self.assertEqual(['sky'], photos[3]['tags'])
+    self.assertEqual([{'id': 2, 'path': '/lib/2.jpg'}], removed)
+    self.assertEqual(
+        set([('label', 'red'), ('label', 'blue'), ('tag', 'sea'),
+             ('tag', 'sky'), ('year', '2010'), ('month', '2010', '01'),
+             ('day', '2010', '01', '01'), ('day', '2010', '01', '02')]),
+        set(self.follower.folder_changes))
+
+  def testReloadsWhenBehindTheLog(self):
+    self.db._CHANGES_LOG_SIZE = 1
+    self.db.WriteBatch([_Meta(3)], [], [])
+    self.db.WriteBatch([_Meta(4)], [], [])
+    self.follower._PollChanges()
+    self.assertEqual([None], self.listener.calls)
+
+
+class MigrationTest(IndexTestCase):
+  '''Indexes written before the schema was versioned are migrated.'''
+
+  # the schema as created by photofs 1.2 and earlier
+  _V0_COLUMNS = [
+      'path', 'datetime', 'last_modified', 'year', 'month', 'day', 'f', 'iso',
+      'make', 'camera', 'focal_length', 'lens_model', 'lens_spec', 'label']
+
+  def WriteV0Db(self, metas, deleted=()):
+    conn = sqlite3.connect(PhotoDb('/lib', self.index_dir).db_path)
+    conn.execute(
+        'CREATE TABLE `files_tags` (`path`, `tag`, `files_rowid`, `datetime`)')
+    conn.execute(
+        'CREATE TABLE `files` (`id` INTEGER PRIMARY KEY AUTOINCREMENT, %s)' %
+        ','.join(self._V0_COLUMNS))
+    for column in self._V0_COLUMNS:
+      conn.execute(
+          'CREATE INDEX `files-{0}-index` ON `files` (`{0}`)'.format(column))
+    for meta in metas:
+      cursor = conn.execute(
+          'INSERT INTO `files` (%s) VALUES(%s)' % (
+              ','.join(self._V0_COLUMNS), ','.join('?' * len(self._V0_COLUMNS))),
+          [meta[c] for c in self._V0_COLUMNS])
+      for tag in meta['tags']:
+        conn.execute('INSERT INTO files_tags VALUES(?, ?, ?, ?)', (
+            meta['path'], tag, cursor.lastrowid, meta['datetime']))
+    for path in deleted:
+      conn.execute('DELETE FROM files WHERE path = ?', (path,))
+      conn.execute('DELETE FROM files_tags WHERE path = ?', (path,))
+    conn.commit()
+    conn.close()
+
+  def testMigratesBaselineIndex(self):
+    self.WriteV0Db([
+        _Meta(1), _Meta(2, label=None, tags=()), _Meta(3, day='02'),
+        _Meta(1, day='03', tags=('sky',)),  # indexed twice, the last wins
+        _Meta(4, year='2011', label='blue', tags=('sea', 'sky')), _Meta(5)],
+        deleted=['/lib/5.jpg'])
+    db = self.OpenDb()
+    conn = sqlite3.connect(db.db_path)
+    self.addCleanup(conn.close)
+    self.assertEqual(PhotoDb._SCHEMA_VERSION,
+                     conn.execute('PRAGMA user_version').fetchone()[0])
+
+    self.assertEqual(set(['2010', '2011']), db.GetYears())
+    self.assertEqual(set(['01', '02', '03']), db.GetDays('2010', '01'))
+    self.assertEqual([2, 3, 4], db.ListPhotosByYear('2010'))
+    self.assertEqual(set(['red', 'blue']), db.GetLabels())
+    self.assertEqual(set(['sea', 'sky']), db.GetTags())
+    self.assertEqual([3, 5], db.ListPhotosByTags(['sea']))
+    self.assertEqual([4, 5], db.ListPhotosByTags(['sky']))
+    self.assertEqual(
+        [(u'2010', u'01', u'01', 1), (u'2010', u'01', u'02', 1),
+         (u'2010', u'01', u'03', 1),
+         (u'2011', u'01', u'01', 1)],
+        conn.execute('SELECT * FROM date_counts ORDER BY 1, 2, 3').fetchall())
+
+    # ids of deleted photos are not handed out again
+    db.WriteBatch([_Meta(7)], [], ['/lib/4.jpg'])
+    self.assertEqual([2, 7, 3, 4], db.ListPhotosByYear('2010'))
+    self.assertEqual([(u'red', 3)], conn.execute(
+        'SELECT * FROM label_counts ORDER BY 1').fetchall())
+
+  def testReopensCurrentIndex(self):
+    db = self.OpenDb()
+    db.WriteBatch([_Meta(1)], [], [])
+    self.CloseDb(db)
+    db = self.OpenDb()
+    self.assertEqual([1], db.ListPhotosByYear('2010'))
+
+  def testRefusesNewerIndex(self):
+    db = self.OpenDb()
+    with db._Connection() as conn:
+      conn.execute('PRAGMA user_version = %d' % (PhotoDb._SCHEMA_VERSION + 1))
+    self.CloseDb(db)
+    self.assertRaises(RuntimeError, self.OpenDb)
+
+
+if __name__ == '__main__':
+  unittest.main()
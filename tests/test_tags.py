@@ -0,0 +1,55 @@
+# -*- encoding: utf-8 -*-
+
+'''test_tags.py: checks the tag postings saved between mounts.'''
+
+__author__ = 'drseergio@gmail.com (Sergey Pisarenko)'
+
+import os
+import unittest
+
+from photofs.cache import PhotoFileCache
+from photofs.tags import TagIndex
+from photofs.views import GetViews
+from tests.test_storage import IndexTestCase, _Meta
+
+
+class TagIndexTest(IndexTestCase):
+  def Mount(self):
+    '''Opens the index like a new mount and returns its TagIndex.'''
+    for db in self.dbs:
+      self.CloseDb(db)
+    return TagIndex(self.OpenDb())
+
+  def testSavedPostingsNamePhotos(self):
+    path = os.path.join(self.index_dir, 'photo.jpg')
+    open(path, 'w').write('jpeg')
+    tag_index = self.Mount()
+    tag_index.WriteBatch([dict(_Meta(1), path=path)], [], [])
+    tag_index.Save()
+
+    tag_index = self.Mount()
+    self.assertFalse(tag_index.rebuilt)
+    views = GetViews(tag_index, PhotoFileCache(tag_index, 1 << 20),
+                     None, None, None)
+    [name] = views['tags'].readdir(['sea'], 0)
+    self.assertEqual('1 (0x1).jpg', name)
+    self.assertEqual(4, views['tags'].getattr(['sea', name]).st_size)
+
+  def testRebuiltPostingsReplaceSavedOnes(self):
+    tag_index = self.Mount()
+    tag_index.WriteBatch([_Meta(1, tags=('foo',)), _Meta(2)], [], [])
+    tag_index.Save()
+    # the photo is deleted but the postings aren't saved again
+    tag_index.WriteBatch([], [], ['/lib/1.jpg'])
+
+    tag_index = self.Mount()
+    self.assertTrue(tag_index.rebuilt)
+    tag_index.Save()
+    tag_index = self.Mount()
+    self.assertFalse(tag_index.rebuilt)
+    self.assertEqual(set(['sea']), tag_index.GetTags())
+    self.assertEqual([], tag_index.ListPhotosByTags(['foo']))
+
+
+if __name__ == '__main__':
+  unittest.main()